@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+
+# For copyrights, see LICENCE.md file!
+
+from fractions import Fraction
+from itertools import islice, permutations
+import argparse
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from stv import (Action, Ballot, BallotStore, CountState, ENGINES,
+                 EventStream, Hopefuls, IncrementalCount, MissingRandomValue,
+                 count_stv, explore_ties, load_ballots, normalise_ballots,
+                 read_csv_ballots)
+
+def pile_store(size, num_candidates=40):
+    """Returns a store with size distinct ballots, all for the first candidate.
+
+    Each ballot ranks the first candidate followed by a distinct sequence
+    of four other candidates, so that the store keeps size separate
+    ballots in a single pile.
+    """
+
+    names = ["C{0}".format(i) for i in range(num_candidates)]
+    store = BallotStore()
+    for rest in islice(permutations(names[1:], 4), size):
+        store.add((names[0],) + rest)
+    if len(store) < size:
+        raise ValueError("Not enough candidates for {0} ballots".format(size))
+    return store
+
+def fit_exponent(sizes, times):
+    """Returns the least squares slope of log(times) against log(sizes).
+
+    A slope close to 1 means that the times scale linearly with the sizes.
+    """
+
+    xs = [math.log(x) for x in sizes]
+    ys = [math.log(y) for y in times]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    return covariance / variance
+
+def benchmark_pile(sizes, engine, repeat):
+    """Times the elimination of a candidate holding a pile of each size.
+
+    Returns a list of (size, seconds) pairs, with the best time of the
+    given number of repetitions.
+    """
+
+    results = []
+    for size in sizes:
+        store = pile_store(size)
+        hopefuls = Hopefuls(len(store.names))
+        hopefuls.remove(0)
+        best = None
+        for _ in range(repeat):
+            counter = ENGINES[engine](store)
+            vote_count = counter.initial_count()
+            start = time.perf_counter()
+            counter.redistribute(0, 1.0, hopefuls, vote_count)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append((size, best))
+    return results
+
+def electorate(num_ballots, num_candidates, seed=0):
+    """Returns the text of a CSV file with a synthetic electorate.
+
+    Preferences follow a Plackett-Luce model, truncated geometrically;
+    see generate_ballots.py, which requires NumPy.
+    """
+
+    from generate_ballots import (candidate_names, generate_chunk,
+                                  model_parameters)
+
+    parameters = model_parameters('plackett-luce', num_candidates, seed)
+    return generate_chunk((0, num_ballots, 'plackett-luce', parameters,
+                           ('geometric', 0.3), 'csv', 'one',
+                           candidate_names(num_candidates), seed))
+
+def write_electorate(path, num_ballots, num_candidates, seed=0):
+    """Writes a synthetic electorate to a CSV file; see electorate."""
+
+    with open(path, 'w', newline='') as ballots_file:
+        ballots_file.write(electorate(num_ballots, num_candidates, seed))
+
+def time_count(text, seats, constituencies, quota, engine, seed=0):
+    """Times the phases of a count of the ballots in the CSV text.
+
+    Ties are broken by a random generator with the seed. Returns the
+    seconds taken to read the ballots, to set up the count with the
+    initial count, and to carry out the rounds, and the number of rounds.
+    """
+
+    start = time.perf_counter()
+    store = load_ballots(normalise_ballots(read_csv_ballots(
+        io.StringIO(text))), constituencies)
+    ingested = time.perf_counter()
+    state = CountState(store, seats, constituencies=constituencies,
+                       quota_limit=quota, engine=engine,
+                       rng=random.Random(seed))
+    counted = time.perf_counter()
+    state.run(EventStream())
+    finished = time.perf_counter()
+    return (ingested - start, counted - ingested, finished - counted,
+            state.current_round - 1)
+
+PHASES = ['ingest', 'initial', 'rounds']
+
+def grid_constituencies(num_candidates, quota, num_constituencies):
+    """Returns the constituencies of the candidates of a grid election.
+
+    There are no constituencies without a quota; otherwise the
+    candidates are dealt in turn to num_constituencies constituencies.
+    """
+
+    if not quota:
+        return {}
+    return {"C{0}".format(i): i % num_constituencies
+            for i in range(num_candidates)}
+
+def benchmark_grid(sizes, candidates, seats, quotas, engine, repeat,
+                   num_constituencies=2, seed=0):
+    """Times counts over a grid of electorates and count settings.
+
+    For each number of ballots and of candidates, a synthetic electorate
+    is counted for each number of seats and each constituency quota; a
+    quota of 0 means no constituencies, otherwise the candidates are
+    dealt to num_constituencies constituencies. Returns a list of
+    results, with the best time of each phase over the repetitions.
+    """
+
+    results = []
+    for size in sizes:
+        for num_candidates in candidates:
+            text = electorate(size, num_candidates, seed)
+            for num_seats in seats:
+                for quota in quotas:
+                    constituencies = grid_constituencies(
+                        num_candidates, quota, num_constituencies)
+                    best = None
+                    for _ in range(repeat):
+                        times = time_count(text, num_seats, constituencies,
+                                           quota, engine, seed)
+                        if best is None:
+                            best = list(times)
+                        else:
+                            best = [min(x, y) for x, y in zip(best, times)]
+                    result = {'ballots': size, 'candidates': num_candidates,
+                              'seats': num_seats, 'quota': quota,
+                              'engine': engine, 'num_rounds': best[3]}
+                    result.update(zip(PHASES, best))
+                    results.append(result)
+    return results
+
+def grid_fits(results):
+    """Returns the scaling exponents of the phases of the grid results.
+
+    For each phase, the times are fitted against the number of ballots
+    for each setting of the other parameters, and against the number of
+    candidates likewise, where there is more than one value to fit.
+    """
+
+    fits = []
+    for variable in ('ballots', 'candidates'):
+        others = [x for x in ('ballots', 'candidates', 'seats', 'quota')
+                  if x != variable]
+        groups = {}
+        for result in results:
+            key = tuple(result[x] for x in others)
+            groups.setdefault(key, []).append(result)
+        for key, group in sorted(groups.items()):
+            if len(set(x[variable] for x in group)) < 2:
+                continue
+            fit = dict(zip(others, key), variable=variable)
+            for phase in PHASES:
+                fit[phase] = fit_exponent([x[variable] for x in group],
+                                          [x[phase] for x in group])
+            fits.append(fit)
+    return fits
+
+def peak_rss():
+    """Returns the peak resident set size of the process in bytes.
+
+    The peak only grows over the life of the process. It is None where
+    the resource module is not available.
+    """
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class RoundMemory:
+    """Records the memory traced by tracemalloc at the start of each round.
+
+    The recorder is a subscriber to the events of a count, and records
+    the bytes allocated since it was created.
+    """
+
+    def __init__(self):
+        self.start = tracemalloc.get_traced_memory()[0]
+        self.rounds = []
+
+    def accepts(self, action):
+        return action == Action.COUNT_ROUND
+
+    def __call__(self, event):
+        self.rounds.append((event.round,
+                            tracemalloc.get_traced_memory()[0] - self.start))
+
+def memory_count(path, seats, constituencies, quota, engine, seed=0):
+    """Measures the memory taken by a count of the ballots in a CSV file.
+
+    Memory is traced with tracemalloc, which must not be tracing
+    already. The bytes held are measured for the ballots store after
+    ingestion, for the count once it is set up, at the peak of the
+    rounds and at the start of each round, and for the Ballot objects
+    read from the file, together with the peak resident set size of
+    the process after each phase, in which the overhead of tracemalloc
+    is included.
+    """
+
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        with open(path, newline='') as ballots_file:
+            store = load_ballots(normalise_ballots(read_csv_ballots(
+                ballots_file)), constituencies)
+        ingested, ingest_peak = tracemalloc.get_traced_memory()
+        ingest_rss = peak_rss()
+        state = CountState(store, seats, constituencies=constituencies,
+                           quota_limit=quota, engine=engine,
+                           rng=random.Random(seed))
+        counted = tracemalloc.get_traced_memory()[0]
+        count_rss = peak_rss()
+        recorder = RoundMemory()
+        tracemalloc.reset_peak()
+        state.run(EventStream([recorder]))
+        finished, rounds_peak = tracemalloc.get_traced_memory()
+        rounds_rss = peak_rss()
+        # Ballot objects are measured last, so that holding them all does
+        # not raise the peak resident set size of the count
+        with open(path, newline='') as ballots_file:
+            ballots = list(read_csv_ballots(ballots_file))
+        ballot_objects = tracemalloc.get_traced_memory()[0] - finished
+        num_ballots = len(ballots)
+        del ballots
+    finally:
+        tracemalloc.stop()
+    growth = [y - x for (_, x), (_, y) in zip(recorder.rounds,
+                                               recorder.rounds[1:])]
+    return {
+        'stored_ballots': len(store),
+        'ballot_object_bytes': ballot_objects / num_ballots,
+        'ingest_bytes': ingested - start,
+        'ingest_peak_bytes': ingest_peak - start,
+        'bytes_per_ballot': (ingested - start) / num_ballots,
+        'bytes_per_stored_ballot': (ingested - start) / len(store),
+        'count_bytes': counted - ingested,
+        'rounds_peak_bytes': rounds_peak - start,
+        'rounds_peak_bytes_per_ballot': (rounds_peak - start) / num_ballots,
+        'rounds_growth_bytes': finished - counted,
+        'round_bytes': [{'round': x, 'bytes': y}
+                        for x, y in recorder.rounds],
+        'max_round_growth_bytes': max(growth, default=0),
+        'peak_rss': {'ingest': ingest_rss, 'count': count_rss,
+                     'rounds': rounds_rss},
+    }
+
+def benchmark_memory(sizes, candidates, seats, quotas, engine,
+                     num_constituencies=2, seed=0):
+    """Measures the memory of counts over a grid of electorates.
+
+    The grid is that of benchmark_grid. Each count is measured in a
+    process of its own, reading the ballots from a temporary file that
+    is written by another process, so that the peak resident set size
+    is that of the count alone: on Linux the peak of a process is
+    inherited by the processes that it starts. Returns
+    a list of results, one per count, with the measures of memory_count.
+    """
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for size in sizes:
+        for num_candidates in candidates:
+            with tempfile.NamedTemporaryFile(suffix='.csv',
+                                             delete=False) as ballots_file:
+                pass
+            try:
+                with context.Pool(1) as pool:
+                    pool.apply(write_electorate, (ballots_file.name, size,
+                                                  num_candidates, seed))
+                for num_seats in seats:
+                    for quota in quotas:
+                        constituencies = grid_constituencies(
+                            num_candidates, quota, num_constituencies)
+                        result = {'ballots': size,
+                                  'candidates': num_candidates,
+                                  'seats': num_seats, 'quota': quota,
+                                  'engine': engine}
+                        with context.Pool(1) as pool:
+                            result.update(pool.apply(memory_count, (
+                                ballots_file.name, num_seats, constituencies,
+                                quota, engine, seed)))
+                        results.append(result)
+            finally:
+                os.remove(ballots_file.name)
+    return results
+
+def add_grid_arguments(parser):
+    """Adds the arguments of a grid of elections to a parser."""
+
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000],
+                        dest='sizes', help='numbers of ballots')
+    parser.add_argument('--candidates', type=int, nargs='+',
+                        default=[10, 40], dest='candidates',
+                        help='numbers of candidates')
+    parser.add_argument('--seats', type=int, nargs='+', default=[3],
+                        dest='seats', help='numbers of seats')
+    parser.add_argument('--quotas', type=int, nargs='+', default=[0],
+                        dest='quotas',
+                        help='constituency quotas, 0 for none')
+    parser.add_argument('--constituencies', type=int, default=2,
+                        dest='constituencies',
+                        help='number of constituencies with quotas')
+    parser.add_argument('-e', '--engine', default='python',
+                        choices=sorted(ENGINES),
+                        dest='engine', help='counting engine')
+    parser.add_argument('--seed', type=int, default=0,
+                        dest='seed', help='electorate random seed')
+    parser.add_argument('-o', '--output', dest='output_file',
+                        help='JSON results file')
+
+def random_election(rng, max_candidates=8, max_ballots=80):
+    """Returns the names, ballots, seats and count options of an election.
+
+    The election is small and drawn from rng, a random.Random instance,
+    with any of the count options: Droop or fractional Droop threshold
+    or not, constituencies with a quota, either engine, and fixed point
+    numbers.
+    """
+
+    names = ["C{0}".format(i) for i in range(rng.randint(2, max_candidates))]
+    ballots = [rng.sample(names, rng.randint(1, len(names)))
+               for _ in range(rng.randint(1, max_ballots))]
+    seats = rng.randint(1, 3)
+    options = {'droop': rng.random() < 0.8}
+    options['fractional'] = options['droop'] and rng.random() < 0.3
+    if rng.random() < 0.3:
+        options['constituencies'] = {name: i % 3
+                                     for i, name in enumerate(names)}
+        options['quota_limit'] = 1
+    options['engine'] = rng.choice(sorted(ENGINES))
+    options['decimals'] = rng.choice([None, None, 2])
+    return names, ballots, seats, options
+
+def rounded_results(results):
+    """Returns count results with votes rounded, for comparisons."""
+
+    elected, vote_count = results
+    return ([(x[0], x[1], round(float(x[2]), 6)) for x in elected],
+            {x: round(float(y), 6) for x, y in vote_count.items()})
+
+def check_incremental(runs, seed=0):
+    """Compares incremental counts with full counts of random elections.
+
+    Each election is counted with an IncrementalCount, which is then
+    updated with two batches of a few late ballots, and the results are
+    compared with those of a count of all the ballots. A first batch
+    whose update stops on a tie is still counted by the second update.
+    Elections whose first count or last update has ties are skipped.
+    Returns the numbers of last updates made without and with counting
+    all the ballots again, and the seeds of the elections whose results
+    differ.
+    """
+
+    updated = recounted = 0
+    mismatches = []
+    for run in range(runs):
+        rng = random.Random(seed + run)
+        names, ballots, seats, options = random_election(rng)
+        late = [[rng.sample(names, rng.randint(1, len(names)))
+                 for _ in range(rng.randint(0, 4))] for _ in range(2)]
+        try:
+            count = IncrementalCount([Ballot(x) for x in ballots], seats,
+                                     **options)
+            count.count(rnd_gen=[])
+        except MissingRandomValue:
+            continue
+        try:
+            count.add([Ballot(x) for x in late[0]], rnd_gen=[])
+        except MissingRandomValue:
+            pass
+        try:
+            results = count.add([Ballot(x) for x in late[1]], rnd_gen=[])
+            full = count_stv([Ballot(x) for x in ballots + late[0]
+                              + late[1]], seats, rnd_gen=[], **options)
+        except MissingRandomValue:
+            continue
+        if count.recounted:
+            recounted += 1
+        else:
+            updated += 1
+        if rounded_results(results) != rounded_results(full):
+            mismatches.append(seed + run)
+    return updated, recounted, mismatches
+
+def enumerate_ties(store, seats, options, selections=()):
+    """Returns the probability of each outcome of the random selections.
+
+    The ballots of the store are counted again from the first round for
+    every sequence of random selections, given with -r, following each
+    selection among n tied candidates with probability 1/n. Outcomes
+    are sets of elected candidates, given as sorted tuples of names.
+    """
+
+    try:
+        elected, _ = count_stv(store, seats, rnd_gen=list(selections),
+                               **options)
+    except MissingRandomValue as tie:
+        winner_sets = {}
+        share = Fraction(1, len(tie.candidates))
+        for candidate in tie.candidates:
+            for winner_set, probability in enumerate_ties(
+                    store, seats, options,
+                    selections + (candidate,)).items():
+                winner_sets[winner_set] = (winner_sets.get(winner_set, 0)
+                                           + share * probability)
+        return winner_sets
+    return {tuple(sorted(x[0] for x in elected)): Fraction(1)}
+
+def check_explore(runs, seed=0):
+    """Compares explore_ties with counts of every sequence of selections.
+
+    The probabilities of the outcomes of small random elections, most
+    of them with ties, are found by explore_ties and by enumerate_ties.
+    Returns the number of elections with more than one outcome, and the
+    seeds of the elections whose probabilities differ.
+    """
+
+    uncertain = 0
+    mismatches = []
+    for run in range(runs):
+        rng = random.Random(seed + run)
+        names, ballots, seats, options = random_election(rng, 6, 12)
+        store = load_ballots([Ballot(x) for x in ballots],
+                             options.get('constituencies', {}))
+        expected = enumerate_ties(store, seats, options)
+        _, winner_sets, _ = explore_ties(CountState(store, seats,
+                                                    **options))
+        if len(expected) > 1:
+            uncertain += 1
+        if winner_sets != expected:
+            mismatches.append(seed + run)
+    return uncertain, mismatches
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark STV counting')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    pile_parser = subparsers.add_parser(
+        'pile', help='time the redistribution of a single large pile')
+    pile_parser.add_argument('--sizes', type=int, nargs='+',
+                             default=[10000, 100000, 1000000],
+                             dest='sizes', help='pile sizes')
+    pile_parser.add_argument('-e', '--engine', default='python',
+                             choices=sorted(ENGINES),
+                             dest='engine', help='counting engine')
+    pile_parser.add_argument('--repeat', type=int, default=3,
+                             dest='repeat', help='repetitions per size')
+    grid_parser = subparsers.add_parser(
+        'grid', help='time the phases of counts over a grid of elections')
+    add_grid_arguments(grid_parser)
+    grid_parser.add_argument('--repeat', type=int, default=3,
+                             dest='repeat', help='repetitions per count')
+    memory_parser = subparsers.add_parser(
+        'memory', help='measure the memory of counts over a grid of '
+        'elections')
+    add_grid_arguments(memory_parser)
+    check_parser = subparsers.add_parser(
+        'check', help='check the results of shortcuts against plain counts '
+        'of random elections')
+    check_parser.add_argument('--runs', type=int, default=2000,
+                              dest='runs', help='number of elections')
+    check_parser.add_argument('--seed', type=int, default=0,
+                              dest='seed', help='seed of the first election')
+    args = parser.parse_args()
+
+    if args.benchmark == 'check':
+        updated, recounted, mismatches = check_incremental(args.runs,
+                                                           args.seed)
+        print("Incremental counts: {0} updated, {1} recounted, "
+              "{2} mismatches {3}".format(updated, recounted,
+                                          len(mismatches), mismatches))
+        uncertain, explore_mismatches = check_explore(args.runs, args.seed)
+        print("Explored ties: {0} elections with several outcomes, "
+              "{1} mismatches {2}".format(uncertain,
+                                          len(explore_mismatches),
+                                          explore_mismatches))
+        if mismatches or explore_mismatches:
+            sys.exit(1)
+    elif args.benchmark == 'pile':
+        results = benchmark_pile(args.sizes, args.engine, args.repeat)
+        for size, elapsed in results:
+            print("{0:>10} ballots {1:10.4f} s {2:8.1f} ns/ballot".format(
+                size, elapsed, 1e9 * elapsed / size))
+        if len(results) > 1:
+            print("Scaling exponent: {0:.2f}".format(
+                fit_exponent(*zip(*results))))
+    else:
+        if args.benchmark == 'grid':
+            results = benchmark_grid(args.sizes, args.candidates, args.seats,
+                                     args.quotas, args.engine, args.repeat,
+                                     args.constituencies, args.seed)
+            report = {'results': results, 'fits': grid_fits(results)}
+        else:
+            report = {'results': benchmark_memory(
+                args.sizes, args.candidates, args.seats, args.quotas,
+                args.engine, args.constituencies, args.seed)}
+        if args.output_file:
+            with open(args.output_file, 'w') as output_file:
+                json.dump(report, output_file, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            print()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+# For copyrights, see LICENCE.md file!
+
+from multiprocessing import Pool
+import argparse
+import json
+import math
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MODELS = ['impartial', 'plackett-luce', 'zipf', 'spatial-1d', 'spatial-2d']
+FORMATS = ['csv', 'json', 'ndjson']
+
+def candidate_names(num_candidates):
+    """Returns the names of the candidates."""
+
+    return ["C{0}".format(i) for i in range(num_candidates)]
+
+def model_parameters(model, num_candidates, seed, zipf_exponent=1.0):
+    """Returns the parameters of a preference model for the candidates.
+
+    For the impartial, Plackett-Luce and Zipf models these are the log
+    weights of the candidates: equal, log-normally distributed, or
+    falling as a power of the popularity rank. For the spatial models
+    they are the positions of the candidates, normally distributed in
+    one or two dimensions.
+    """
+
+    rng = numpy.random.default_rng([seed, 0])
+    if model == 'impartial':
+        return numpy.zeros(num_candidates)
+    if model == 'plackett-luce':
+        return rng.normal(size=num_candidates)
+    if model == 'zipf':
+        return -zipf_exponent * numpy.log(numpy.arange(1, num_candidates + 1))
+    dimensions = 1 if model == 'spatial-1d' else 2
+    return rng.normal(size=(num_candidates, dimensions))
+
+def rankings(model, parameters, size, rng, depth=None):
+    """Returns a matrix with the top depth ranks of a ranking in each row.
+
+    Rankings of the weight models are Plackett-Luce samples, drawn by
+    sorting the log weights perturbed with Gumbel noise; in the spatial
+    models voters are normally distributed and rank the candidates by
+    their distance. Only the depth candidates ranked first are sorted,
+    all of them by default.
+    """
+
+    num_candidates = len(parameters)
+    if not model.startswith('spatial'):
+        keys = -(parameters + rng.gumbel(size=(size, num_candidates)))
+    else:
+        voters = rng.normal(size=(size, parameters.shape[1]))
+        # The squared distances, less the squared norm of each voter,
+        # which leaves the order of the candidates of a voter unchanged
+        keys = (parameters ** 2).sum(axis=1) - 2 * voters @ parameters.T
+    if depth is None or depth >= num_candidates:
+        return numpy.argsort(keys, axis=1)
+    top = numpy.argpartition(keys, depth - 1, axis=1)[:, :depth]
+    order = numpy.argsort(numpy.take_along_axis(keys, top, axis=1), axis=1)
+    return numpy.take_along_axis(top, order, axis=1)
+
+def parse_truncation(truncation):
+    """Returns the (kind, parameter) pair of a truncation specification.
+
+    The specification is 'full', 'uniform', 'geometric:P', where P is
+    the probability of stopping after each preference, or 'fixed:K'.
+    """
+
+    kind, _, parameter = truncation.partition(':')
+    if kind in ('full', 'uniform') and not parameter:
+        return kind, None
+    if kind == 'geometric' and parameter and 0 < float(parameter) <= 1:
+        return kind, float(parameter)
+    if kind == 'fixed' and parameter and int(parameter) > 0:
+        return kind, int(parameter)
+    raise ValueError("Invalid truncation: {0}".format(truncation))
+
+def lengths(truncation, size, num_candidates, rng):
+    """Returns the number of preferences of each one of size ballots."""
+
+    kind, parameter = truncation
+    if kind == 'full':
+        return numpy.full(size, num_candidates)
+    if kind == 'uniform':
+        return rng.integers(1, num_candidates + 1, size=size)
+    if kind == 'geometric':
+        return numpy.minimum(rng.geometric(parameter, size=size),
+                             num_candidates)
+    return numpy.full(size, min(parameter, num_candidates))
+
+def generate_chunk(job):
+    """Returns the text of a chunk of ballots.
+
+    The chunk is drawn from a random generator seeded with the seed and
+    the number of the chunk, so that the ballots do not depend on the
+    number of processes.
+    """
+
+    (index, size, model, parameters, truncation, output_format, balances,
+     names, seed) = job
+    rng = numpy.random.default_rng([seed, index + 1])
+    cut = lengths(truncation, size, len(names), rng)
+    depth = int(cut.max()) if size else 0
+    ranked = rankings(model, parameters, size, rng, depth).tolist()
+    cut = cut.tolist()
+    ballots = [[names[x] for x in ranking[:length]]
+               for ranking, length in zip(ranked, cut)]
+    if output_format == 'csv':
+        return ''.join(','.join(ballot) + '\n' for ballot in ballots)
+    if balances == 'one':
+        weights = [1] * size
+    else:
+        weights = numpy.round(rng.lognormal(size=size), 2).tolist()
+    records = [json.dumps({"candidates": ballot, "balance": weight})
+               for ballot, weight in zip(ballots, weights)]
+    if output_format == 'ndjson':
+        return ''.join(record + '\n' for record in records)
+    return ',\n'.join(records)
+
+def write_ballots(output_file, num_ballots, num_candidates, model='impartial',
+                  truncation=('full', None), output_format='csv',
+                  balances='one', seed=0, processes=None, chunk_size=100000,
+                  zipf_exponent=1.0):
+    """Writes num_ballots generated ballots to the output file.
+
+    Chunks of chunk_size ballots are generated in parallel by a pool of
+    processes, by default as many as there are CPUs, and written in
+    order as they are ready. Chunks are smaller for many candidates, so
+    that a chunk never ranks more than ten million candidates in all.
+    """
+
+    if numpy is None:
+        raise ImportError("NumPy is required to generate ballots")
+    chunk_size = max(1, min(chunk_size, 10 ** 7 // num_candidates))
+    names = candidate_names(num_candidates)
+    parameters = model_parameters(model, num_candidates, seed, zipf_exponent)
+    jobs = ((index, min(chunk_size, num_ballots - start), model, parameters,
+             truncation, output_format, balances, names, seed)
+            for index, start in enumerate(range(0, num_ballots, chunk_size)))
+    if output_format == 'json':
+        output_file.write('[')
+    with Pool(processes) as pool:
+        for index, text in enumerate(pool.imap(generate_chunk, jobs)):
+            if output_format == 'json' and index > 0:
+                output_file.write(',\n')
+            output_file.write(text)
+    if output_format == 'json':
+        output_file.write(']\n')
+
+def write_constituencies(constituencies_file, num_candidates,
+                         num_constituencies):
+    """Writes the candidates, dealt in turn to the constituencies, as CSV."""
+
+    names = candidate_names(num_candidates)
+    for constituency in range(num_constituencies):
+        constituencies_file.write(
+            ','.join(names[constituency::num_constituencies]) + '\n')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate STV ballots')
+    parser.add_argument('-o', '--output', default='sys.stdout',
+                        dest='output_file', help='output ballots file')
+    parser.add_argument('-n', '--ballots', type=int, default=1000,
+                        dest='ballots', help='number of ballots')
+    parser.add_argument('-k', '--candidates', type=int, default=10,
+                        dest='candidates', help='number of candidates')
+    parser.add_argument('-s', '--seats', type=int, default=0,
+                        dest='seats', help='number of seats to suggest '
+                        'for counting')
+    parser.add_argument('-m', '--model', default='impartial', choices=MODELS,
+                        dest='model', help='preference model')
+    parser.add_argument('--zipf-exponent', type=float, default=1.0,
+                        dest='zipf_exponent',
+                        help='exponent of the zipf model')
+    parser.add_argument('-t', '--truncation', default='full',
+                        dest='truncation',
+                        help='number of preferences per ballot: full, '
+                        'uniform, geometric:P or fixed:K')
+    parser.add_argument('-f', '--format', default='csv', choices=FORMATS,
+                        dest='format', help='output format')
+    parser.add_argument('--balances', default='one',
+                        choices=['one', 'lognormal'], dest='balances',
+                        help='balances of JSON voter records')
+    parser.add_argument('-c', '--constituencies', type=int, default=0,
+                        dest='constituencies',
+                        help='number of constituencies')
+    parser.add_argument('--constituencies-output',
+                        dest='constituencies_file',
+                        help='output constituencies file')
+    parser.add_argument('--seed', type=int, default=0, dest='seed',
+                        help='random seed')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        dest='processes', help='number of processes')
+    parser.add_argument('--chunk-size', type=int, default=100000,
+                        dest='chunk_size', help='ballots per chunk')
+    args = parser.parse_args()
+
+    try:
+        truncation = parse_truncation(args.truncation)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.constituencies and not args.constituencies_file:
+        parser.error("The constituencies need --constituencies-output")
+
+    output_file = sys.stdout
+    if args.output_file != 'sys.stdout':
+        output_file = open(args.output_file, 'w', newline='')
+    write_ballots(output_file, args.ballots, args.candidates, args.model,
+                  truncation, args.format, args.balances, args.seed,
+                  args.processes, args.chunk_size, args.zipf_exponent)
+    if output_file is not sys.stdout:
+        output_file.close()
+
+    command = ['stv.py', '-b', args.output_file]
+    if args.format != 'csv':
+        command.append('-j')
+    if args.seats:
+        command.extend(['-s', str(args.seats)])
+    if args.constituencies:
+        with open(args.constituencies_file, 'w') as constituencies_file:
+            write_constituencies(constituencies_file, args.candidates,
+                                 args.constituencies)
+        command.extend(['-c', args.constituencies_file, '-q',
+                        str(math.ceil(max(args.seats, 1)
+                                      / args.constituencies))])
+    if output_file is not sys.stdout:
+        print("Count with: " + ' '.join(command), file=sys.stderr)
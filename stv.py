@@ -2,14 +2,40 @@
 
 # For copyrights, see LICENCE.md file!
 
-from operator import mul, itemgetter
-from random import random, seed
+from operator import mul, itemgetter, lt
+from random import random, seed, Random
+from array import array
+from itertools import accumulate, compress
+from heapq import heapify, heappop, heappush
+from collections import namedtuple, Counter
+from contextlib import contextmanager, nullcontext
+from decimal import Decimal
 import logging
+import hashlib
+import io
+import mmap
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import pickle
+import re
+import stat
+import struct
+import tempfile
+import time
+import tracemalloc
 import sys
 import math
 import csv
 import json
 import argparse
+import copy
+from fractions import Fraction
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 SVT_LOGGER = 'SVT'
 LOGGER_FORMAT = '%(message)s'
@@ -26,33 +52,904 @@ class Action:
     RANDOM = "*RANDOM"
     THRESHOLD = "^THRESHOLD"
 
+class FloatArithmetic:
+    """Floating point arithmetic for ballot values and tallies.
+
+    Amounts of votes are plain numbers; ballot values start at 1.0 and
+    are multiplied by the transfer values.
+
+    """
+
+    scale = None
+    one = 1.0
+    typecode = 'd'
+
+    def amount(self, number):
+        """Returns a number of votes as an amount."""
+
+        return number
+
+    def display(self, amount):
+        """Returns an amount as a number of votes."""
+
+        return amount
+
+    def counts(self, store):
+        """Returns the ballot counts of the store as amounts."""
+
+        return store.counts
+
+    def transfer_value(self, surplus, votes):
+        """Returns the transfer value of a surplus out of votes."""
+
+        return float(surplus) / votes
+
+class FixedPointArithmetic:
+    """Fixed point arithmetic for ballot values and tallies.
+
+    Amounts of votes are integers, in units of 10 ** -decimals of a vote,
+    so that tallies are exact and do not depend on the order of
+    additions. As in STV legislation, transfer values and the values of
+    transferred ballots are truncated to the given number of decimal
+    places, and the fractions of votes lost are not counted. At most 9
+    decimals are allowed, so that products of values fit in 64 bits.
+
+    """
+
+    typecode = 'q'
+
+    def __init__(self, decimals):
+        if not 0 <= decimals <= 9:
+            raise ValueError("Decimals must be between 0 and 9")
+        self.decimals = decimals
+        self.scale = 10 ** decimals
+        self.one = self.scale
+
+    def amount(self, number):
+        """Returns a number of votes as an amount, truncated."""
+
+        if isinstance(number, float):
+            number = Decimal(repr(number))
+        return math.floor(number * self.scale)
+
+    def display(self, amount):
+        """Returns an amount as a Decimal number of votes."""
+
+        return Decimal(amount).scaleb(-self.decimals)
+
+    def counts(self, store):
+        """Returns the ballot counts of the store as amounts."""
+
+        return array('q', map(self.amount, store.counts))
+
+    def transfer_value(self, surplus, votes):
+        """Returns the transfer value of a surplus out of votes."""
+
+        return surplus * self.scale // votes
+
+# An event in the course of a count. The round is the counting round, if
+# any. The candidate and the value depend on the action:
+#   THRESHOLD: the value is the election threshold
+#   COUNT_ROUND: the round starts
+#   COUNT, ZOMBIES: the details are (candidate, votes) pairs
+#   ELECT, QUOTA, ELIMINATE: the candidate and their votes
+#   TRANSFER: the candidate transferring, the value of each ballot, and
+#             details of the form (to_candidate, number of ballots)
+#   RANDOM: the candidate selected, and details of the form
+#           (candidates selected among, action of the selection)
+Event = namedtuple('Event', ['action', 'round', 'candidate', 'value',
+                             'details'])
+
+def describe_event(event):
+    """Returns the description of an event, as it is logged."""
+
+    action = event.action
+    if action == Action.THRESHOLD:
+        return str(event.value)
+    elif action == Action.COUNT_ROUND:
+        return str(event.round)
+    elif action in (Action.COUNT, Action.ZOMBIES):
+        return ';'.join(map(lambda x: "{0} = {1}".format(*x),
+                            event.details))
+    elif action == Action.TRANSFER:
+        to_candidate, times = event.details
+        return "from {0} to {1} {2}*{3}={4}".format(event.candidate,
+                                                    to_candidate, times,
+                                                    event.value,
+                                                    times * event.value)
+    elif action == Action.RANDOM:
+        collected, selection_action = event.details
+        return "{0} from {1} to {2}".format(event.candidate, collected,
+                                            selection_action)
+    else:
+        return event.candidate + " = " + str(event.value)
+
+class LogSubscriber:
+    """Logs the events of a count, one line per event.
+
+    Transfers are logged at the DEBUG level, all other events at the
+    INFO level. Only the events that the logger would output are
+    accepted.
+
+    """
+
+    def __init__(self, logger=None):
+        if logger is None:
+            logger = logging.getLogger(SVT_LOGGER)
+        self.logger = logger
+
+    def level(self, action):
+        if action == Action.TRANSFER:
+            return logging.DEBUG
+        return logging.INFO
+
+    def accepts(self, action):
+        return self.logger.isEnabledFor(self.level(action))
+
+    def __call__(self, event):
+        self.logger.log(self.level(event.action),
+                        LOG_MESSAGE.format(action=event.action,
+                                           desc=describe_event(event)))
+
+class EventStream:
+    """Delivers the events of a count to its subscribers.
+
+    A subscriber is a callable that takes an Event. A subscriber with
+    an accepts method is only given the actions it accepts. As building
+    an event, and the data it carries, costs time, callers check with
+    wants whether any subscriber accepts an action before they build an
+    event for it. Events carry amounts of votes as they are counted;
+    display, if given, turns them into numbers of votes.
+
+    """
+
+    def __init__(self, subscribers=(), display=None):
+        self.subscribers = list(subscribers)
+        self.display = display
+        self._wanted = {}
+
+    def _accepting(self, action):
+        return [subscriber for subscriber in self.subscribers
+                if not hasattr(subscriber, 'accepts')
+                or subscriber.accepts(action)]
+
+    def wants(self, action):
+        """Returns true if any subscriber accepts the action."""
+
+        if action not in self._wanted:
+            self._wanted[action] = bool(self._accepting(action))
+        return self._wanted[action]
+
+    def emit(self, event):
+        if self.display is not None:
+            event = self._displayed(event)
+        for subscriber in self._accepting(event.action):
+            subscriber(event)
+
+    def _displayed(self, event):
+        display = self.display
+        value = event.value
+        details = event.details
+        if event.action in (Action.COUNT, Action.ZOMBIES):
+            details = [(x[0], display(x[1])) for x in details]
+        elif event.action == Action.TRANSFER and isinstance(details[1], float):
+            details = (details[0], Decimal(repr(details[1])))
+        if value is not None:
+            value = display(value)
+        return event._replace(value=value, details=details)
+
 class Ballot:
     """A ballot class for Single Transferable Voting.
 
     The ballot class contains an ordered list of candidates (in
-    decreasing order of preference) and an ordered list of weights
-    (new weights are added to the front of the list). The index of the
-    current preference (for the first count and subsequent rounds)
-    is also kept.
+    decreasing order of preference), and the current value of the
+    ballot, as weights are added to it. The index of the current
+    preference (for the first count and subsequent rounds) is also
+    kept. The count is the number of identical ballots that the ballot
+    stands for; for weighted ballots it is the voting weight of the
+    ballot, which need not be a whole number. Counts read ballots into
+    a BallotStore and do not change them; the weights applied during a
+    count are only kept by a WeightHistory.
 
     """
 
     candidates = []
-    weights = [1.0]
     current_preference = 0
     _value = 1.0
+    count = 1
 
-    def __init__(self, candidates=[]):
+    def __init__(self, candidates=[], count=1):
         self.candidates = candidates
+        self.count = count
 
     def add_weight(self, weight):
-        self.weights.insert(0, weight)
         self._value *= weight
 
     def get_value(self):
         return self._value
+
+class BallotStore:
+    """A compact store of grouped ballots for Single Transferable Voting.
+
+    Candidate names are interned to small integer ids, in the order in
+    which they are first seen, so that names holds the name of each id
+    and ids the id of each name. The preferences of all the ballots are
+    kept in a single flat array of candidate ids, and the preferences of
+    the i-th ballot are preferences[offsets[i]:offsets[i + 1]]. Ballots
+    with identical preferences are stored once; the count of a ballot
+    is the sum of the counts of the ballots it stands for. Counts are
+    kept as integers until a fractional count is added.
+
+    """
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.preferences = array('I')
+        self.offsets = array('Q', [0])
+        self.counts = array('Q')
+        # The index of each ballot, keyed by the bytes of its preferences.
+        self._index = {}
+
+    def __len__(self):
+        return len(self.counts)
+
+    def intern(self, name):
+        """Returns the id of the candidate, adding it if it is new."""
+
+        candidate_id = self.ids.get(name)
+        if candidate_id is None:
+            candidate_id = len(self.names)
+            self.ids[name] = candidate_id
+            self.names.append(name)
+        return candidate_id
+
+    def add(self, candidates, count=1):
+        """Adds count ballots with the given candidates to the store.
+
+        Empty ballots carry no preferences and are not stored.
+        """
+
+        if not candidates:
+            return
+        if self.counts.typecode == 'Q' and count != int(count):
+            self.counts = array('d', self.counts)
+        if self.counts.typecode == 'Q':
+            count = int(count)
+        preferences = array('I', map(self.intern, candidates))
+        key = preferences.tobytes()
+        index = self._index.get(key)
+        if index is None:
+            self._index[key] = len(self.counts)
+            self.preferences.extend(preferences)
+            self.offsets.append(len(self.preferences))
+            self.counts.append(count)
+        else:
+            self.counts[index] += count
+
+    def extend(self, ballots):
+        """Adds each one of the given Ballot objects to the store."""
+
+        for ballot in ballots:
+            self.add(ballot.candidates, ballot.count)
+
+    def total(self):
+        """Returns the total count of the ballots in the store."""
+
+        return sum(self.counts)
+
+    def candidates(self, index):
+        """Returns the candidate names of the ballot at index."""
+
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return [self.names[x] for x in self.preferences[start:end]]
+
+    def copy(self):
+        """Returns a copy of the store, to which ballots can be added.
+
+        The copy of a binary store holds arrays instead of views.
+        """
+
+        store = BallotStore()
+        store.names = list(self.names)
+        store.ids = dict(self.ids)
+        store.preferences = array('I', _as_array(self.preferences))
+        store.offsets = array('Q', _as_array(self.offsets))
+        store.counts = array(memoryview(self.counts).format,
+                             _as_array(self.counts))
+        preferences = store.preferences
+        offsets = store.offsets
+        for index in range(len(store)):
+            key = preferences[offsets[index]:offsets[index + 1]].tobytes()
+            store._index[key] = index
+        return store
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('preferences', 'offsets', 'counts'):
+            state[name] = _as_array(state[name])
+        return state
+
+def _as_array(values):
+    """Returns an array copy of a memoryview, which cannot be pickled.
+
+    Arrays, and other values, are returned as they are.
+    """
+
+    if isinstance(values, memoryview):
+        copy = array(values.format)
+        copy.frombytes(values.cast('B'))
+        return copy
+    return values
+
+def read_csv_ballots(ballots_file):
+    """Yields a Ballot for each line of a CSV ballots file."""
+
+    ballots_reader = csv.reader(ballots_file, delimiter=',',
+                                quotechar='"',
+                                skipinitialspace=True)
+    for ballot in ballots_reader:
+        yield Ballot(ballot)
+
+JSON_BLANKS = re.compile(r'[ \t\n\r]*')
+
+def iter_json_records(json_file, chunk_size=1 << 16,
+                      max_record_size=1 << 22):
+    """Yields the records of a JSON file one at a time.
+
+    The file holds either a single top level array of records or
+    newline delimited records, one after the other. It is read in
+    chunks of chunk_size characters and only the text of the record
+    being decoded is kept in memory, so that the size of the file does
+    not matter. A record that cannot be decoded from max_record_size
+    characters is taken to be invalid.
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    at_end = False
+    in_array = None
+    # Within an array, whether a record must follow (after a comma),
+    # must not follow (after a record) or may follow (after the '[').
+    expect_record = None
+    closed = False
+    while True:
+        position = JSON_BLANKS.match(buffer, position).end()
+        if position == len(buffer):
+            if at_end:
+                break
+            chunk = json_file.read(chunk_size)
+            at_end = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        char = buffer[position]
+        if closed:
+            raise ValueError("Extra data after the JSON array")
+        if in_array is None:
+            in_array = char == '['
+            if in_array:
+                position += 1
+                continue
+        if in_array and char == ']' and expect_record is not True:
+            closed = True
+            position += 1
+            continue
+        if in_array and expect_record is False:
+            if char != ',':
+                raise ValueError("Expecting ',' delimiter between "
+                                 "JSON records")
+            position += 1
+            expect_record = True
+            continue
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            record, end = None, None
+        # A record may be cut short at the end of the buffer, in which
+        # case it is decoded again once more text has been read. The
+        # text read doubles each time, so that a long record is copied
+        # and decoded a logarithmic number of times.
+        if end is None or (end == len(buffer) and not at_end):
+            pending = len(buffer) - position
+            if at_end or pending > max_record_size:
+                raise ValueError("Invalid JSON record")
+            chunk = json_file.read(max(chunk_size, pending))
+            at_end = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield record
+        position = end
+        expect_record = False
+    if in_array and not closed:
+        raise ValueError("Unterminated JSON array")
+
+def read_json_ballots(ballots_file):
+    """Yields a Ballot for each voter record of a JSON ballots file.
+
+    Each voter record is a single ballot weighted by its balance. The
+    file is read incrementally, see iter_json_records.
+    """
+
+    for v in iter_json_records(ballots_file):
+        yield Ballot(v["candidates"], float(v["balance"]))
+
+def normalise_ballots(ballots):
+    """Yields the given ballots with their candidate names cleaned up.
+
+    Blanks around candidate names are stripped and empty names are
+    dropped; ballots left without candidates are skipped.
+    """
+
+    for ballot in ballots:
+        candidates = [x.strip() for x in ballot.candidates]
+        ballot.candidates = [x for x in candidates if x]
+        if ballot.candidates:
+            yield ballot
+
+def load_ballots(ballots, candidates=()):
+    """Returns a BallotStore with the ballots, an iterable of Ballot objects.
+
+    The ballots are taken one at a time and grouped as they arrive, so
+    that an iterable that reads them lazily is never held in memory as
+    a whole; only the distinct ballots are. The given candidates are
+    interned first, in order.
+    """
+
+    store = BallotStore()
+    for candidate in candidates:
+        store.intern(candidate)
+    store.extend(ballots)
+    return store
+
+# A binary ballots file starts with a header holding the magic bytes,
+# the format version, the typecode of the counts ('Q' or 'd'), and the
+# numbers of candidates, ballots and preferences. The header is
+# followed by the byte length of each candidate name and the UTF-8
+# names, padded to 8 bytes, and then by the counts, the offsets and
+# the preferences of a BallotStore, one section after the other. All
+# numbers are little endian.
+BINARY_MAGIC = b'STVB'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sHcxIQQ4x')
+
+def _little_endian(values):
+    """Returns an array or memoryview of numbers in little endian order."""
+
+    if sys.byteorder == 'big':
+        values = array(memoryview(values).format, values)
+        values.byteswap()
+    return values
+
+def write_binary_ballots(store, binary_file):
+    """Writes the ballots of the store to a binary ballots file."""
+
+    counts = store.counts
+    typecode = memoryview(counts).format
+    encoded = [name.encode('utf-8') for name in store.names]
+    binary_file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION,
+                                         typecode.encode('ascii'),
+                                         len(encoded), len(store),
+                                         len(store.preferences)))
+    binary_file.write(_little_endian(array('I', map(len, encoded))))
+    names = b''.join(encoded)
+    padding = -(4 * len(encoded) + len(names)) % 8
+    binary_file.write(names + bytes(padding))
+    binary_file.write(_little_endian(counts))
+    binary_file.write(_little_endian(store.offsets))
+    binary_file.write(_little_endian(store.preferences))
+
+def binary_store(buffer):
+    """Returns a BallotStore viewing the binary ballots held in buffer.
+
+    The counts, offsets and preferences of the store are memoryviews of
+    the buffer, so that nothing is copied, except on big endian
+    machines. The store is read only: ballots cannot be added to it.
+    """
+
+    view = memoryview(buffer)
+    if len(view) < BINARY_HEADER.size:
+        raise ValueError("Truncated binary ballots file")
+    (magic, version, typecode, num_candidates, num_ballots,
+     num_preferences) = BINARY_HEADER.unpack_from(view)
+    if magic != BINARY_MAGIC:
+        raise ValueError("Not a binary ballots file")
+    if version != BINARY_VERSION:
+        raise ValueError("Unsupported binary ballots version "
+                         "{0}".format(version))
+
+    def section(position, typecode, length):
+        end = position + array(typecode).itemsize * length
+        if end > len(view):
+            raise ValueError("Truncated binary ballots file")
+        values = view[position:end].cast(typecode)
+        if sys.byteorder == 'big':
+            values = array(typecode, values)
+            values.byteswap()
+        return values, end
+
+    lengths, position = section(BINARY_HEADER.size, 'I', num_candidates)
+    store = BallotStore()
+    for length in lengths:
+        name = bytes(view[position:position + length])
+        store.intern(name.decode('utf-8'))
+        position += length
+    position += -position % 8
+    store.counts, position = section(position, typecode.decode('ascii'),
+                                     num_ballots)
+    store.offsets, position = section(position, 'Q', num_ballots + 1)
+    store.preferences, position = section(position, 'I', num_preferences)
+    return store
+
+def load_binary_ballots(path):
+    """Returns a BallotStore mapping the binary ballots file at path.
+
+    The file is memory mapped, so that the ballots are loaded lazily by
+    the operating system and shared between processes that count them.
+    """
+
+    with open(path, 'rb') as binary_file:
+        mapped = mmap.mmap(binary_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return binary_store(mapped)
+
+def is_binary_ballots(path):
+    """Returns whether the file at path is a binary ballots file."""
+
+    with open(path, 'rb') as ballots_file:
+        return ballots_file.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+def is_regular_file(path):
+    """Returns whether path is a regular file, which can be read twice.
+
+    Pipes and other special files are consumed as they are read.
+    """
+
+    return stat.S_ISREG(os.stat(path).st_mode)
+
+def read_constituencies(path):
+    """Returns the constituency of each candidate in a constituencies file.
+
+    Each line of the CSV file lists the candidates of a constituency;
+    constituencies are numbered from 0 in the order of the lines.
+    """
+
+    constituencies = {}
+    with open(path, newline='') as constituencies_file:
+        constituencies_reader = csv.reader(constituencies_file,
+                                           delimiter=',',
+                                           quotechar='"',
+                                           skipinitialspace=True)
+        constituency_id = 0
+        for constituency in constituencies_reader:
+            for candidate in constituency:
+                if candidate.strip():
+                    constituencies[candidate.strip()] = constituency_id
+            constituency_id += 1
+    return constituencies
+
+def ballots_cache_key(path, json_format, candidates):
+    """Returns the cache key of the ballots file at path.
+
+    The key is a SHA-256 digest of the contents of the file and of the
+    options that decide how it is read into a store.
+    """
+
+    digest = hashlib.sha256()
+    options = [BINARY_VERSION, bool(json_format), list(candidates)]
+    digest.update(json.dumps(options).encode('utf-8'))
+    with open(path, 'rb') as ballots_file:
+        for chunk in iter(lambda: ballots_file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_ballots(path, json_format=False, candidates=(), cache_dir=None):
+    """Returns a BallotStore with the ballots of the file at path.
+
+    The path 'sys.stdin' stands for the standard input. A binary
+    ballots file is memory mapped; otherwise the file is read as JSON
+    if json_format is true and as CSV if not, and its ballots are
+    cleaned up and grouped one at a time, so that only the distinct
+    ballots are kept in memory. The given candidates are interned
+    first, in order.
+
+    If a cache directory is given, the store read from a file is saved
+    there as a binary ballots file, and later reads of the same file
+    with the same options map the saved file instead. A cached file
+    that cannot be read, as it is truncated or corrupt, is saved
+    again. The standard input is never cached.
+
+    Only regular files are mapped or cached. Other files, such as
+    pipes, are read once, in full for binary ballots.
+    """
+
+    if path == 'sys.stdin':
+        return read_text_ballots(sys.stdin, json_format, candidates)
+    regular = is_regular_file(path)
+    if regular and is_binary_ballots(path):
+        store = load_binary_ballots(path)
+        for candidate in candidates:
+            store.intern(candidate)
+        return store
+    if cache_dir is not None and regular:
+        key = ballots_cache_key(path, json_format, candidates)
+        cache_path = os.path.join(cache_dir, key + '.stvb')
+        if os.path.exists(cache_path):
+            try:
+                return load_binary_ballots(cache_path)
+            except ValueError:
+                pass
+        store = read_ballots(path, json_format, candidates)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first, so that concurrent runs
+        # never see a partly written cache file.
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp',
+                                         delete=False) as cache_file:
+            write_binary_ballots(store, cache_file)
+        os.replace(cache_file.name, cache_path)
+        return store
+    with open(path, 'rb') as binary_file:
+        # Look at the start of the file without consuming it, as the
+        # file may not be read again
+        if binary_file.peek(len(BINARY_MAGIC)).startswith(BINARY_MAGIC):
+            store = binary_store(binary_file.read())
+            for candidate in candidates:
+                store.intern(candidate)
+            return store
+        ballots_file = io.TextIOWrapper(binary_file, newline='')
+        return read_text_ballots(ballots_file, json_format, candidates)
+
+def read_text_ballots(ballots_file, json_format=False, candidates=()):
+    """Returns a BallotStore with the ballots of a CSV or JSON text file.
+
+    The ballots are read as in read_ballots.
+    """
+
+    if not json_format:
+        ballots = read_csv_ballots(ballots_file)
+    else:
+        ballots = read_json_ballots(ballots_file)
+    return load_ballots(normalise_ballots(ballots), candidates)
+
+class Hopefuls:
+    """The hopeful candidates of a count, as a set of candidate ids.
+
+    Membership is kept in a bytearray with a flag for each candidate id,
+    so that checking and removing a candidate take constant time.
+    Iteration yields the hopeful candidates in order of id.
+
+    """
+
+    def __init__(self, num_candidates):
+        self.flags = bytearray(b'\x01') * num_candidates
+        self.size = num_candidates
+
+    def __contains__(self, candidate):
+        return bool(self.flags[candidate])
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return compress(range(len(self.flags)), self.flags)
+
+    def remove(self, candidate):
+        if not self.flags[candidate]:
+            raise ValueError("Not a hopeful candidate: {0}".format(candidate))
+        self.flags[candidate] = 0
+        self.size -= 1
+    
+class CandidateRanking:
+    """Ranks the hopeful candidates of a count by their vote count.
+
+    The ranking keeps a max-heap and a min-heap of the hopefuls, with
+    entries of their vote counts and ids. Entries are not removed when
+    the votes of a candidate change, or when a candidate stops being
+    hopeful; instead, fresh entries are pushed for the candidates whose
+    votes changed, and stale entries are dropped when they reach the top
+    of a heap. The heaps are rebuilt when they grow much larger than the
+    number of hopefuls.
+
+    """
+
+    def __init__(self, vote_count, hopefuls):
+        self.vote_count = vote_count
+        self.hopefuls = hopefuls
+        self.rebuild()
+
+    def rebuild(self):
+        """Rebuilds the heaps from the current vote count."""
+
+        vote_count = self.vote_count
+        self.highest = [(-vote_count[x], x) for x in self.hopefuls]
+        self.lowest = [(vote_count[x], -x) for x in self.hopefuls]
+        heapify(self.highest)
+        heapify(self.lowest)
+
+    def update(self, candidates):
+        """Records that the votes of the given candidates have changed."""
+
+        vote_count = self.vote_count
+        for candidate in candidates:
+            if candidate in self.hopefuls:
+                heappush(self.highest, (-vote_count[candidate], candidate))
+                heappush(self.lowest, (vote_count[candidate], -candidate))
+        if len(self.highest) > 2 * len(self.hopefuls) + 64:
+            self.rebuild()
+
+    def best(self):
+        """Returns the hopefuls tied for the most votes, by increasing id."""
+
+        vote_count = self.vote_count
+        top = self._pop_ties(self.highest,
+                             lambda x: -x[0] == vote_count[x[1]]
+                             and x[1] in self.hopefuls)
+        return [x[1] for x in top]
+
+    def worst(self):
+        """Returns the hopefuls tied for the fewest votes, by decreasing id."""
+
+        vote_count = self.vote_count
+        top = self._pop_ties(self.lowest,
+                             lambda x: x[0] == vote_count[-x[1]]
+                             and -x[1] in self.hopefuls)
+        return [-x[1] for x in top]
+
+    def lowest_until(self, limit, count):
+        """Returns the hopefuls with the fewest votes, by increasing votes.
+
+        Hopefuls are taken, ties by decreasing id, until their votes
+        together reach limit or count of them are taken. Stale entries on
+        the way are dropped; the entries taken are left in the heap.
+        """
+
+        vote_count = self.vote_count
+        heap = self.lowest
+        taken = []
+        total = 0
+        while heap and total < limit and len(taken) < count:
+            entry = heappop(heap)
+            if (entry[0] == vote_count[-entry[1]]
+                    and -entry[1] in self.hopefuls
+                    and (not taken or entry != taken[-1])):
+                taken.append(entry)
+                total += entry[0]
+        for entry in taken:
+            heappush(heap, entry)
+        return [-x[1] for x in taken]
+
+    @staticmethod
+    def _pop_ties(heap, is_valid):
+        """Returns the valid entries tied at the top of the heap.
+
+        Stale entries on the way are dropped; the tied entries are left
+        in the heap, without duplicates.
+        """
+
+        top = []
+        while heap:
+            entry = heap[0]
+            if not is_valid(entry):
+                heappop(heap)
+            elif top and entry[0] != top[0][0]:
+                break
+            else:
+                heappop(heap)
+                if not top or entry != top[-1]:
+                    top.append(entry)
+        for entry in top:
+            heappush(heap, entry)
+        return top
+    
+class WeightHistory:
+    """An append-only history of the weights applied to ballots in a count.
+
+    The history holds one record for each transfer: the round, the id
+    of the candidate whose ballots were transferred, the weight, and
+    the end of the run of ballots it moved in the ballots array, which
+    holds the indices of the ballots moved by each transfer, in
+    increasing order, one after the other. Weights are in the arithmetic
+    of the count, so in fixed point counts they are scaled integers. The
+    names map candidate ids to names.
+
+    """
+
+    def __init__(self):
+        self.names = []
+        self.rounds = array('I')
+        self.candidates = array('I')
+        self.weights = array('d')
+        self.ends = array('Q')
+        self.ballots = array('I')
+
+    def __len__(self):
+        return len(self.weights)
+
+    def record(self, current_round, selected, weight, ballots):
+        """Records a transfer of the given ballot indices."""
+
+        self.ballots.extend(ballots)
+        self.rounds.append(current_round or 0)
+        self.candidates.append(selected)
+        self.weights.append(weight)
+        self.ends.append(len(self.ballots))
+
+    def transfers(self):
+        """Yields (round, candidate name, weight, ballots) for each transfer."""
+
+        start = 0
+        for i, end in enumerate(self.ends):
+            yield (self.rounds[i], self.names[self.candidates[i]],
+                   self.weights[i], self.ballots[start:end])
+            start = end
+
+    def weights_of(self, ballot):
+        """Returns the weights applied to the ballot, in order."""
+
+        return [weight for _, _, weight, ballots in self.transfers()
+                if ballot in ballots]
     
-def randomly_select_first(sequence, key, action, random_generator=None):
+class MissingRandomValue(Exception):
+    """Raised when there is no value left for a random selection.
+
+    The candidates are the candidates to select among.
+    """
+
+    def __init__(self, candidates):
+        Exception.__init__(self, "Missing value for random selection "
+                           "among {0}".format(candidates))
+        self.candidates = candidates
+
+class PromptTieBreaker:
+    """Asks which candidate to select when candidates are tied.
+
+    The question is written to the output file, and the name of the
+    selected candidate is read as a line from the input file, which is
+    the standard input by default. If a path is given instead, such as
+    that of a named pipe, answers are read from the file at that path,
+    which is opened again whenever its writer closes it. Names that are
+    not among the tied candidates are asked for again. If the input
+    ends, MissingRandomValue is raised.
+
+    """
+
+    def __init__(self, path=None, input_file=None, output_file=None):
+        self.path = path
+        self.input_file = input_file
+        self.output_file = output_file or sys.stdout
+
+    def _readline(self):
+        if self.path is None:
+            return (self.input_file or sys.stdin).readline()
+        for _ in range(2):
+            if self.input_file is None:
+                self.input_file = open(self.path)
+            line = self.input_file.readline()
+            if line:
+                return line
+            self.input_file.close()
+            self.input_file = None
+        return ''
+
+    def __call__(self, candidates, action):
+        while True:
+            self.output_file.write("Select among {0} to {1}: ".format(
+                candidates, action))
+            self.output_file.flush()
+            line = self._readline()
+            if not line:
+                self.output_file.write("\n")
+                raise MissingRandomValue(candidates)
+            selected = line.strip()
+            if selected in candidates:
+                return selected
+            self.output_file.write("Not a tied candidate: {0}\n".format(
+                selected))
+
+def randomly_select_first(sequence, key, action, random_generator=None,
+                          events=None, current_round=None, tie_breaker=None,
+                          rng=None):
     """Selects the first item of equals in a sorted sequence of items.
 
     For the given sorted sequence, returns the first item if it
@@ -61,8 +958,14 @@ def randomly_select_first(sequence, key, action, random_generator=None):
     The value of each item in the sequence is provided by applying the
     function key to the item. The action parameter indicates the context
     in which the random selection takes place (election or elimination).
-    random_generator, if given, is the function that produces the random
-    selection.
+    random_generator, if given, is a list of the selections to make, which
+    are taken from its start. Once it runs out, the selection is made by
+    tie_breaker, if given, a callable that takes the tied items and the
+    action and returns the selected item; otherwise MissingRandomValue
+    is raised. Without either, the selection is random, drawn from rng,
+    a random.Random instance, or else from the random module. Random
+    selections are reported to the events stream, or logged if there is
+    none.
 
     """
 
@@ -77,275 +980,1401 @@ def randomly_select_first(sequence, key, action, random_generator=None):
     selected = collected[index]
     num_eligibles = len(collected)
     if (num_eligibles > 1):
-        if random_generator is None:
-            index = int(random() * num_eligibles)
+        if random_generator:
+            selected = random_generator.pop(0)
+        elif tie_breaker is not None:
+            selected = tie_breaker(collected, action)
+        elif random_generator is None:
+            draw = random() if rng is None else rng.random()
+            index = int(draw * num_eligibles)
             selected = collected[index]
         else:
-            if not random_generator:
-                print("Missing value for random selection among ", collected)
-                sys.exit(1)
-            selected = random_generator.pop(0)
-        logger = logging.getLogger(SVT_LOGGER)
-        description = "{0} from {1} to {2}".format(selected, collected, action)
-        logger.info(LOG_MESSAGE.format(action=Action.RANDOM, desc=description))
+            raise MissingRandomValue(collected)
+        if events is None:
+            events = EventStream([LogSubscriber()])
+        if events.wants(Action.RANDOM):
+            events.emit(Event(Action.RANDOM, current_round, selected, None,
+                              (collected, action)))
     return selected
         
     
-def redistribute_ballots(selected, weight, hopefuls, allocated, vote_count):
+def redistribute_ballots(selected, weight, hopefuls, allocated, vote_count,
+                         store, positions, values, events=None,
+                         current_round=None, counts=None, scale=None,
+                         history=None, stats=None):
     """Redistributes the ballots from selected to the hopefuls.
 
     Redistributes the ballots currently allocated to the selected
-    candidate. The ballots are redistributed with the given weight.
-    The total ballot allocation is given by the allocated map, which
-    is modified accordingly. The current vote count is given by
-    vote_count and is adjusted according to the redistribution.
+    candidate. The ballots are redistributed with the given weight;
+    each ballot carries as many votes as its count in the store.
+    Candidates are given by their ids in the store, and hopefuls is a
+    Hopefuls set. The total ballot allocation is given by allocated, a
+    list with the indices of the ballots allocated to each candidate,
+    which is modified accordingly. The current vote count is given by
+    vote_count and is adjusted according to the redistribution. The
+    position of the current preference of each ballot in
+    store.preferences, and the current value of each ballot, are kept
+    in the positions and values arrays. As ballots are grouped by their
+    preferences and positions only move forward, over a whole count
+    each preference of a distinct ballot is walked past at most once.
+    Transfers are reported to the events stream, if any.
+
+    The counts, if given, replace the counts of the store as the number
+    of votes of each ballot. If a scale is given, counts, values, the
+    weight and the vote count are fixed point integers of that scale.
+    The transfer is recorded in the history, a WeightHistory, if any.
+    The numbers of ballots touched, preferences skipped and ballots
+    exhausted are added to the stats, a CountProfiler round, if given.
+
+    Returns the set of candidates whose vote count has changed.
     
     """
 
-    logger = logging.getLogger(SVT_LOGGER)
-    transferred = []
-    # Keep a hash of ballot moves for logging purposes.
-    # Keys are a tuple of the form (from_recipient, to_recipient, value)
-    # where value is the current value of the ballot. Each tuple points
-    # to the ballot being moved.
+    preferences = store.preferences
+    offsets = store.offsets
+    if counts is None:
+        counts = store.counts
+    is_hopeful = hopefuls.flags
+    # The ballots that stay with the selected candidate, because they
+    # have no further hopeful preference.
+    remaining = array('I')
+    # The candidates whose vote count changes
+    changed = {selected}
+    # The ballots that move, if a history is kept
+    moved = array('I')
+    # Keep a hash of ballot moves for reporting purposes, if anyone
+    # listens. Keys are a tuple of the form (to_recipient, value) where
+    # value is the current value of the ballot. Each tuple points to the
+    # number of ballots being moved.
+    report = events is not None and events.wants(Action.TRANSFER)
     moves = {}
+    # The preferences walked past, as they are not hopeful
+    skipped = 0
 
     for ballot in allocated[selected]:
         reallocated = False
-        i = ballot.current_preference + 1
-        while not reallocated and i < len(ballot.candidates):
-            recipient = ballot.candidates[i]
-            if recipient in hopefuls:
-                ballot.current_preference = i
-                ballot.add_weight(weight)
-                current_value = ballot.get_value()
-                if recipient in allocated:
-                    allocated[recipient].append(ballot)
-                else:
-                    allocated[recipient] = [ballot]
-                if recipient in vote_count:
-                    vote_count[recipient] += current_value
+        i = start = positions[ballot] + 1
+        end = offsets[ballot + 1]
+        while not reallocated and i < end:
+            recipient = preferences[i]
+            if is_hopeful[recipient]:
+                positions[ballot] = i
+                if scale is None:
+                    values[ballot] *= weight
+                    current_value = values[ballot] * counts[ballot]
                 else:
-                    vote_count[recipient] = current_value
+                    values[ballot] = values[ballot] * weight // scale
+                    current_value = counts[ballot] * values[ballot] // scale
+                allocated[recipient].append(ballot)
+                vote_count[recipient] += current_value
                 vote_count[selected] -= current_value
+                changed.add(recipient)
                 reallocated = True
-                if (selected, recipient, current_value) in moves:
-                    moves[(selected, recipient, current_value)].append(ballot)
-                else:
-                    moves[(selected, recipient, current_value)] = [ballot]
-                transferred.append(ballot)
+                if history is not None:
+                    moved.append(ballot)
+                if report:
+                    move = (recipient, values[ballot])
+                    if move in moves:
+                        moves[move] += store.counts[ballot]
+                    else:
+                        moves[move] = store.counts[ballot]
             else:
                 i += 1
-    for move, ballots in moves.items():
-        times = len(ballots)
-        description =  "from {0} to {1} {2}*{3}={4}".format(move[0],
-                                                            move[1],
-                                                            times,
-                                                            move[2],
-                                                            times * move[2])
-        logger.debug(LOG_MESSAGE.format(action=Action.TRANSFER,
-                                        desc=description))
-    allocated[selected][:] = [x for x in allocated[selected]
-                              if x not in transferred ]
+        skipped += i - start
+        if not reallocated:
+            remaining.append(ballot)
+    if stats is not None:
+        stats['ballots_touched'] += len(allocated[selected])
+        stats['preferences_skipped'] += skipped
+        stats['ballots_exhausted'] += len(remaining)
+    if report:
+        emit_moves(selected, moves, store.names, events, current_round)
+    allocated[selected] = remaining
+    if history is not None:
+        # In ballot order rather than pile order, as with every engine
+        history.record(current_round, selected, weight, sorted(moved))
+    return changed
+
+def emit_moves(selected, moves, names, events, current_round):
+    """Reports the transfers of ballots from the selected candidate.
+
+    The moves map has keys of the form (to_recipient, value), pointing
+    to the number of ballots of that value moved to the recipient.
+    """
+
+    for move, times in moves.items():
+        events.emit(Event(Action.TRANSFER, current_round, names[selected],
+                          move[1], (names[move[0]], times)))
 
 def elect_reject(candidate, vote_count, constituencies, quota_limit,
-                 current_round, elected, rejected, constituencies_elected):
+                 current_round, elected, rejected, constituencies_elected,
+                 names, events):
     """Elects or rejects the candidate, based on quota restrictions.
 
     If there are no quota limits, the candidate is elected. If there
     are quota limits, the candidate is either elected or rejected, if
     the quota limits are exceeded. The elected and rejected lists
     are modified accordingly, as well as the constituencies_elected map.
+    The candidate is given by its id; names maps ids to candidate names.
+    The outcome is reported to the events stream.
 
     Returns true if the candidate is elected, false otherwise.
     """
     
     
-    logger = logging.getLogger(SVT_LOGGER)
+    name = names[candidate]
     quota_exceeded = False
     # If there is a quota limit, check if it is exceeded
-    if quota_limit > 0 and candidate in constituencies:
-        current_constituency = constituencies[candidate]
+    if quota_limit > 0 and name in constituencies:
+        current_constituency = constituencies[name]
         if constituencies_elected[current_constituency] >= quota_limit:
             quota_exceeded = True
     # If the quota limit has been exceeded, reject the candidate
     if quota_exceeded:
-        rejected.append((candidate, current_round, vote_count[candidate]))
-        d = candidate + " = " + str(vote_count[candidate])
-        msg = LOG_MESSAGE.format(action=Action.QUOTA, desc=d)
-        logger.info(msg)
+        rejected.append((name, current_round, vote_count[candidate]))
+        if events.wants(Action.QUOTA):
+            events.emit(Event(Action.QUOTA, current_round, name,
+                              vote_count[candidate], None))
         return False
     # Otherwise, elect the candidate
     else:
-        elected.append((candidate, current_round, vote_count[candidate]))
+        elected.append((name, current_round, vote_count[candidate]))
         if constituencies:
-            current_constituency = constituencies[candidate]
+            current_constituency = constituencies[name]
             constituencies_elected[current_constituency] += 1
-        d = candidate + " = " + str(vote_count[candidate])
-        msg = LOG_MESSAGE.format(action=Action.ELECT, desc=d)
-        logger.info(msg)
+        if events.wants(Action.ELECT):
+            events.emit(Event(Action.ELECT, current_round, name,
+                              vote_count[candidate], None))
         return True
 
-def count_description(vote_count, candidates):
-    """Returns a string with count results.
+def count_details(vote_count, candidates, names):
+    """Returns the (candidate, votes) pairs of the given candidates.
 
-    The string is of the form of {0} = {1} separated by ; where each {0}
-    is a candidate and each {1} is the corresponding vote count.
+    Candidates are given by their ids; names maps ids to names.
     """
     
-    return  ';'.join(map(lambda x: "{0} = {1}".format(x, vote_count[x]),
-                         candidates))
+    return [(names[x], vote_count[x]) for x in candidates]
 
    
-def count_stv(ballots, seats, droop = True, constituencies = None,
-              quota_limit = 0, rnd_gen=None, fractional = False):
-    """Performs a STV vote for the given ballots and number of seats.
+class PythonEngine:
+    """Counts the ballots of a store one distinct ballot at a time.
+
+    The engine keeps the allocation of ballots to candidates, and the
+    position of the current preference and the value of each ballot,
+    for redistribute_ballots. Values and votes are counted with the
+    given arithmetic, floating point by default. Transfers are recorded
+    in the history, a WeightHistory, if one is given.
 
-    If droop is true the election threshold is calculated according to the
-    Droop quota:
-            threshold = int(1 + (len(ballots) / (seats + 1.0)))
-    If it is a fractional droop, then it is calculated with:
-            threshold = (len(ballots) / (seats + 1.0))
-    otherwise it is calculated according to the following formula:
-            threshold = int(math.ceil(1 + len(ballots) / (seats + 1.0)))
-    The constituencies argument is a map of candidates to constituencies, if
-    any. The quota_limit, if different than zero, is the limit of candidates
-    that can be elected by a constituency.
     """
-    
-    allocated = {} # The allocation of ballots to candidates
-    vote_count = {} # A hash of ballot counts, indexed by candidates
-    candidates = [] # All candidates
-    elected = [] # The candidates that have been elected
-    hopefuls = [] # The candidates that may be elected
-    # The candidates that have been eliminated because of low counts
-    eliminated = []
-    # The candidates that have been eliminated because of quota restrictions
-    rejected = []
-    # The number of candidates elected per constituency
-    constituencies_elected = {}
-    for candidate, constituency in constituencies.items():
-        constituencies_elected[constituency] = 0
-        if candidate not in allocated:
-            allocated[candidate] = []
-        if candidate not in candidates: # check not really needed
-            candidates.append(candidate)
-            vote_count[candidate] = 0
-
-    seed()
+
+    def __init__(self, store, arithmetic=None, history=None):
+        if arithmetic is None:
+            arithmetic = FloatArithmetic()
+        self.store = store
+        self.history = history
+        self.scale = arithmetic.scale
+        self.counts = arithmetic.counts(store)
+        self.allocated = [array('I') for _ in store.names]
+        # A copy, as the offsets of a binary store are read only
+        self.positions = array('Q')
+        self.positions.frombytes(memoryview(store.offsets)[:-1].cast('B'))
+        self.values = array(arithmetic.typecode, [arithmetic.one]) * len(store)
+
+    def initial_count(self):
+        """Allocates each ballot to its first preference.
+
+        Returns the vote count, indexed by candidate id.
+        """
+
+        store = self.store
+        vote_count = [0] * len(store.names)
+        for ballot in range(len(store)):
+            selected = store.preferences[self.positions[ballot]]
+            self.allocated[selected].append(ballot)
+            vote_count[selected] += self.counts[ballot]
+        return vote_count
+
+    def redistribute(self, selected, weight, hopefuls, vote_count,
+                     events=None, current_round=None, stats=None):
+        """Redistributes the ballots from selected to the hopefuls.
+
+        Returns the candidates whose vote count has changed.
+        """
+
+        return redistribute_ballots(selected, weight, hopefuls,
+                                    self.allocated, vote_count, self.store,
+                                    self.positions, self.values, events,
+                                    current_round, self.counts, self.scale,
+                                    self.history, stats)
+
+    def redistribute_all(self, candidates, weight, hopefuls, vote_count,
+                         events=None, current_round=None, stats=None):
+        """Redistributes the ballots of the candidates to the hopefuls.
+
+        None of the candidates may be hopeful, so that no ballot moves
+        from one of them to another, and their piles are walked once.
+        Returns the candidates whose vote count has changed.
+        """
+
+        changed = set()
+        for selected in candidates:
+            changed.update(self.redistribute(selected, weight, hopefuls,
+                                             vote_count, events,
+                                             current_round, stats))
+        return changed
+
+    def fingerprint(self, digest):
+        """Updates the hash object digest with the state of the engine."""
+
+        digest.update(self.positions)
+        digest.update(self.values)
+        for ballots in self.allocated:
+            digest.update(struct.pack('<Q', len(ballots)))
+            digest.update(ballots)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['counts'] = _as_array(state['counts'])
+        return state
+
+class NumpyEngine:
+    """Counts the ballots of a store with NumPy vector operations.
+
+    The engine works on NumPy views of the preferences and the offsets
+    of the store. The position of the current preference, the value and
+    the current recipient of each ballot are kept in vectors, so that a
+    redistribution is a few masked operations over the ballots of the
+    selected candidate. Values and votes are counted with the given
+    arithmetic, floating point by default; fixed point tallies are
+    summed as 64-bit integers. Transfers are recorded in the history, a
+    WeightHistory, if one is given.
+
+    """
+
+    def __init__(self, store, arithmetic=None, history=None):
+        if numpy is None:
+            raise ImportError("NumPy is required for the numpy engine")
+        if arithmetic is None:
+            arithmetic = FloatArithmetic()
+        self.store = store
+        self.history = history
+        self.scale = arithmetic.scale
+        self.preferences = numpy.frombuffer(store.preferences,
+                                            dtype=numpy.uint32)
+        offsets = numpy.frombuffer(store.offsets, dtype=numpy.uint64)
+        offsets = offsets.astype(numpy.int64)
+        self.ends = offsets[1:]
+        self.positions = offsets[:-1].copy()
+        if self.scale is None:
+            self.counts = numpy.asarray(store.counts).astype(numpy.float64)
+        else:
+            self.counts = numpy.asarray(arithmetic.counts(store),
+                                        dtype=numpy.int64)
+        self.values = numpy.full(len(store), arithmetic.one,
+                                 dtype=self.counts.dtype)
+        self.recipients = self.preferences[self.positions].astype(numpy.int64)
+
+    def initial_count(self):
+        """Allocates each ballot to its first preference.
+
+        Returns the vote count, indexed by candidate id.
+        """
+
+        if self.scale is not None:
+            return self._tally(self.recipients, self.counts).tolist()
+        vote_count = numpy.bincount(self.recipients, weights=self.counts,
+                                    minlength=len(self.store.names))
+        if memoryview(self.store.counts).format == 'Q':
+            vote_count = vote_count.astype(numpy.int64)
+        return vote_count.tolist()
+
+    def _tally(self, recipients, amounts):
+        """Sums integer amounts per recipient, without going through floats."""
+
+        tally = numpy.zeros(len(self.store.names), dtype=numpy.int64)
+        numpy.add.at(tally, recipients, amounts)
+        return tally
+
+    def redistribute(self, selected, weight, hopefuls, vote_count,
+                     events=None, current_round=None, stats=None):
+        """Redistributes the ballots from selected to the hopefuls.
+
+        Returns the candidates whose vote count has changed. Work is
+        added to the stats, as in redistribute_ballots.
+        """
+
+        return self.redistribute_all([selected], weight, hopefuls,
+                                     vote_count, events, current_round,
+                                     stats)
+
+    def redistribute_all(self, candidates, weight, hopefuls, vote_count,
+                         events=None, current_round=None, stats=None):
+        """Redistributes the ballots of the candidates to the hopefuls.
+
+        None of the candidates may be hopeful, so that no ballot moves
+        from one of them to another, and their piles are walked together
+        in a single pass. Returns the candidates whose vote count has
+        changed, as redistribute.
+        """
+
+        is_hopeful = numpy.frombuffer(hopefuls.flags, dtype=bool)
+        is_selected = numpy.zeros(len(self.store.names), dtype=bool)
+        is_selected[candidates] = True
+        pile = numpy.flatnonzero(is_selected[self.recipients])
+        # Walk the ballots of the pile forward from their current
+        # preferences, one preference at a time for all the ballots
+        # still walking, until each reaches a hopeful preference or runs
+        # out of preferences; ballots that run out are exhausted and stay
+        # with their candidate. As positions only move forward, over a
+        # whole count each preference is passed at most once.
+        walking = pile
+        starts = self.positions[pile]
+        positions = starts + 1
+        moved = [pile[:0]]
+        found_at = [positions[:0]]
+        while walking.size:
+            inside = positions < self.ends[walking]
+            walking = walking[inside]
+            positions = positions[inside]
+            found = is_hopeful[self.preferences[positions]]
+            moved.append(walking[found])
+            found_at.append(positions[found])
+            walking = walking[~found]
+            positions = positions[~found] + 1
+        # Put the moved ballots back in ballot order
+        moved = numpy.concatenate(moved)
+        order = numpy.argsort(moved, kind='stable')
+        moved = moved[order]
+        positions = numpy.concatenate(found_at)[order]
+        sources = self.recipients[moved]
+        recipients = self.preferences[positions].astype(numpy.int64)
+        if stats is not None:
+            # The preferences walked past end at the new position of a
+            # moved ballot, and at the end of an exhausted ballot
+            ends = self.ends[pile]
+            ends[numpy.searchsorted(pile, moved)] = positions
+            stats['ballots_touched'] += pile.size
+            stats['preferences_skipped'] += int((ends - starts - 1).sum())
+            stats['ballots_exhausted'] += pile.size - moved.size
+        self.positions[moved] = positions
+        self.recipients[moved] = recipients
+        if self.scale is None:
+            self.values[moved] *= weight
+            amounts = self.values[moved] * self.counts[moved]
+            tally = numpy.bincount(recipients, weights=amounts,
+                                   minlength=len(self.store.names))
+        else:
+            # Split the counts so that no product overflows 64 bits;
+            # this is the same as counts * values // scale.
+            values = self.values[moved] * weight // self.scale
+            self.values[moved] = values
+            quotients, remainders = numpy.divmod(self.counts[moved],
+                                                 self.scale)
+            amounts = quotients * values + remainders * values // self.scale
+            tally = self._tally(recipients, amounts)
+        changed = numpy.flatnonzero(tally).tolist()
+        for recipient in changed:
+            vote_count[recipient] += tally[recipient].item()
+        # The moved ballots of each candidate, in ballot order
+        by_source = numpy.argsort(sources, kind='stable')
+        bounds = numpy.searchsorted(sources[by_source],
+                                    [candidates, numpy.add(candidates, 1)])
+        report = events is not None and events.wants(Action.TRANSFER)
+        for selected, start, end in zip(candidates, *bounds.tolist()):
+            group = by_source[start:end]
+            vote_count[selected] -= amounts[group].sum().item()
+            if report:
+                moves = {}
+                counts = numpy.asarray(self.store.counts)[moved[group]]
+                for recipient, value, count in zip(
+                        recipients[group].tolist(),
+                        self.values[moved[group]].tolist(),
+                        counts.tolist()):
+                    move = (recipient, value)
+                    moves[move] = moves.get(move, 0) + count
+                emit_moves(selected, moves, self.store.names, events,
+                           current_round)
+            if self.history is not None:
+                self.history.record(current_round, selected, weight,
+                                    array('I', moved[group]
+                                          .astype(numpy.uint32).tobytes()))
+        changed.extend(candidates)
+        return changed
+
+    def fingerprint(self, digest):
+        """Updates the hash object digest with the state of the engine."""
+
+        digest.update(self.positions.tobytes())
+        digest.update(self.values.tobytes())
+        digest.update(self.recipients.tobytes())
+
+    def __getstate__(self):
+        # The preferences are a view of the store, restored from it
+        state = self.__dict__.copy()
+        del state['preferences']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.preferences = numpy.frombuffer(self.store.preferences,
+                                            dtype=numpy.uint32)
+
+ENGINES = {
+    'python': PythonEngine,
+    'numpy': NumpyEngine,
+}
+
+def election_threshold(num_ballots, seats, droop=True, fractional=False):
+    """Returns the election threshold, as described in count_stv."""
 
     if droop:
         if not fractional:
-            threshold = int(1 + (len(ballots) / (seats + 1.0)))
+            return int(1 + (num_ballots / (seats + 1)))
+        return (num_ballots / (seats + 1))
+    return int(math.ceil(1 + num_ballots / (seats + 1)))
+
+class CountProfiler:
+    """Times the parts of each round of a count, and counts their work.
+
+    The profiler is given to CountState.step, or to count_stv, and
+    records each round as a dictionary with the round number, whether
+    it is a round with zombies, its wall time, the time spent in each
+    one of PARTS, ranking the hopefuls by their votes, selecting among
+    tied candidates, redistributing ballots and electing or rejecting
+    candidates, and the numbers of ballots touched, preferences skipped
+    and ballots exhausted by the redistributions of the round. If
+    tracemalloc is tracing memory, the bytes allocated over the round,
+    net of the bytes freed, are recorded as well; otherwise they are
+    None. Times are in seconds. The callback, if given, is called with
+    each round as it is recorded. A round that stops with
+    MissingRandomValue is not recorded.
+
+    """
+
+    PARTS = ('ranking', 'selection', 'redistribution', 'elect_reject')
+    COUNTERS = ('ballots_touched', 'preferences_skipped', 'ballots_exhausted')
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.rounds = []
+        # The round being profiled
+        self.stats = None
+        self._started = None
+        self._memory = None
+
+    def start_round(self, current_round, zombies=False):
+        self.stats = {'round': current_round, 'zombies': zombies}
+        self.stats.update(dict.fromkeys(self.PARTS, 0.0))
+        self.stats.update(dict.fromkeys(self.COUNTERS, 0))
+        self._memory = None
+        if tracemalloc.is_tracing():
+            self._memory = tracemalloc.get_traced_memory()[0]
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def timing(self, part):
+        """Adds the time spent in the with block to the part of the round."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stats[part] += time.perf_counter() - start
+
+    def end_round(self):
+        stats = self.stats
+        stats['wall'] = time.perf_counter() - self._started
+        stats['bytes_allocated'] = None
+        if self._memory is not None and tracemalloc.is_tracing():
+            stats['bytes_allocated'] = (tracemalloc.get_traced_memory()[0]
+                                        - self._memory)
+        self.rounds.append(stats)
+        self.stats = None
+        if self.callback is not None:
+            self.callback(stats)
+
+    def trace(self):
+        """Returns the rounds and their totals, as JSON serialisable data."""
+
+        totals = {}
+        for key in ('wall',) + self.PARTS + self.COUNTERS:
+            totals[key] = sum(x[key] for x in self.rounds)
+        allocated = [x['bytes_allocated'] for x in self.rounds]
+        totals['bytes_allocated'] = None
+        if None not in allocated:
+            totals['bytes_allocated'] = sum(allocated)
+        return {'rounds': self.rounds, 'totals': totals}
+
+def _untimed(part):
+    return nullcontext()
+
+class CountState:
+    """The state of a STV count, which can be run and resumed.
+
+    The state is set up with the initial count of the ballots, for the
+    arguments described in count_stv, and is then carried forward one
+    round at a time by step, or to the end of the count by run. As a
+    round changes nothing before its random selection, a state whose
+    count stopped with MissingRandomValue is still the state at the
+    start of that round, and can be saved with save, loaded with load,
+    and run again with more random selections. The manual selections
+    made so far are kept in manual_selections. Random selections are
+    drawn from rng, a random.Random instance, if one is given, and from
+    the freshly seeded random module otherwise.
+
+    """
+
+    def __init__(self, ballots, seats, droop=True, constituencies=None,
+                 quota_limit=0, fractional=False, engine='python',
+                 decimals=None, weight_history=None, rng=None,
+                 bulk_exclusion=False):
+        self.seats = seats
+        self.fractional = fractional
+        self.quota_limit = quota_limit
+        self.bulk_exclusion = bulk_exclusion
+        self.elected = [] # The candidates that have been elected
+        # The candidates that have been eliminated because of low counts
+        self.eliminated = []
+        # The candidates that have been eliminated because of quota
+        # restrictions
+        self.rejected = []
+        # The number of candidates elected per constituency
+        self.constituencies_elected = {}
+        if constituencies is None:
+            constituencies = {}
+        self.constituencies = constituencies
+        if isinstance(ballots, BallotStore):
+            store = ballots
         else:
-            threshold = (len(ballots) / (seats + 1.0))
-    else:
-        threshold = int(math.ceil(1 + len(ballots) / (seats + 1.0)))
+            store = BallotStore()
+        # Candidates in constituencies come first, as they are interned
+        # first
+        for candidate, constituency in constituencies.items():
+            self.constituencies_elected[constituency] = 0
+            store.intern(candidate)
+        if store is not ballots:
+            store.extend(ballots)
+        self.store = store
+        self.names = store.names
+        self.ids = store.ids
 
-    logger = logging.getLogger(SVT_LOGGER)
-    logger.info(LOG_MESSAGE.format(action=Action.THRESHOLD,
-                                   desc=threshold))
-    
-    # Do initial count
-    for ballot in ballots:
-        selected = ballot.candidates[0]
-        for candidate in ballot.candidates:
-            if candidate not in candidates:
-                candidates.append(candidate)
-                vote_count[candidate] = 0
-            if candidate not in allocated:
-                allocated[candidate] = []
-        allocated[selected].append(ballot)
-        vote_count[selected] += 1
-
-    # In the beginning, all candidates are hopefuls
-    hopefuls = [x for x in candidates]
-
-    # Start rounds
-    current_round = 1
-    num_elected = len(elected)
-    num_hopefuls = len(hopefuls)
-    while num_elected < seats and num_hopefuls > 0:
-        # Log round
-        logger.info(LOG_MESSAGE.format(action=Action.COUNT_ROUND,
-                                       desc=current_round))
-        # Log count
-        description  = count_description(vote_count, hopefuls)
-       
-        logger.info(LOG_MESSAGE.format(action=Action.COUNT,
-                                       desc=description))
-        hopefuls_sorted = sorted(hopefuls, key=vote_count.get, reverse=True )
+        self.rng = rng
+        if rng is None:
+            seed()
+
+        if decimals is None:
+            self.arithmetic = FloatArithmetic()
+        else:
+            self.arithmetic = FixedPointArithmetic(decimals)
+
+        threshold = election_threshold(store.total(), seats, droop,
+                                       fractional)
+        # The threshold, in the arithmetic of the count
+        self.threshold = self.arithmetic.amount(threshold)
+
+        # Do initial count. The vote count is indexed by candidate id.
+        if weight_history is not None:
+            weight_history.names = self.names
+        self.counter = ENGINES[engine](store, self.arithmetic,
+                                       weight_history)
+        self.vote_count = self.counter.initial_count()
+
+        # In the beginning, all candidates are hopefuls. These are the
+        # candidates that may be elected.
+        self.hopefuls = Hopefuls(len(self.names))
+        self.ranking = CandidateRanking(self.vote_count, self.hopefuls)
+
+        self.current_round = 1
+        # The number of candidates elected by the end of the last round
+        # with hopefuls; rounds with zombies go on while it leaves seats
+        # to fill.
+        self.num_elected = 0
+        self.manual_selections = []
+
+    def event_stream(self, subscriber=None):
+        """Returns a stream logging the events of the count.
+
+        The events are also given to the subscriber, if any.
+        """
+
+        subscribers = [LogSubscriber()]
+        if subscriber is not None:
+            subscribers.append(subscriber)
+        if self.arithmetic.scale is None:
+            return EventStream(subscribers)
+        return EventStream(subscribers, self.arithmetic.display)
+
+    def finished(self):
+        """Returns whether the count is over."""
+
+        seats_left = self.seats - self.num_elected
+        return seats_left <= 0 or (len(self.hopefuls) == 0
+                                   and len(self.eliminated) == 0)
+
+    def _by_votes(self, name):
+        # Randomly select among candidates by name, as -r values are names
+        return self.vote_count[self.ids[name]]
+
+    def _hopeless(self):
+        """Returns the hopefuls to exclude together, by increasing votes.
+
+        These are the most hopefuls with the fewest votes whose votes
+        together are fewer than the votes of the next hopeful, and so
+        fewer than the threshold, leaving at least as many hopefuls as
+        there are seats left. They could never overtake the next
+        hopeful, whatever the transfers between them. Only the lowest
+        hopefuls with fewer votes together than the best hopeful are
+        looked at, as no more of them can have fewer votes together than
+        the next one.
+        """
+
+        vote_count = self.vote_count
+        most = len(self.hopefuls) - math.ceil(self.seats - self.num_elected)
+        if most <= 0:
+            return []
+        ranking = self.ranking
+        lowest = ranking.lowest_until(vote_count[ranking.best()[0]],
+                                      most + 1)
+        votes = list(map(vote_count.__getitem__, lowest))
+        # The numbers of lowest hopefuls with fewer votes together than
+        # the next hopeful
+        possible = compress(range(1, len(votes)),
+                            map(lt, accumulate(votes), votes[1:]))
+        hopeless = lowest[:max(possible, default=0)]
+        hopeless.sort(key=lambda x: (vote_count[x], x))
+        return hopeless
+
+    def _select(self, candidates, action, events, rnd_gen, tie_breaker):
+        """Selects among the candidate ids tied at the start of candidates.
+
+        Returns the name of the selected candidate.
+        """
+
+        num_values = len(rnd_gen) if rnd_gen is not None else 0
+        breaker = None
+        if tie_breaker is not None:
+            def breaker(tied, action):
+                selected = tie_breaker(tied, action)
+                self.manual_selections.append(selected)
+                return selected
+        selected = randomly_select_first(
+            [self.names[x] for x in candidates],
+            key=self._by_votes,
+            action=action,
+            random_generator=rnd_gen,
+            events=events,
+            current_round=self.current_round,
+            tie_breaker=breaker,
+            rng=self.rng)
+        if rnd_gen is not None and len(rnd_gen) < num_values:
+            self.manual_selections.append(selected)
+        return selected
+
+    def step(self, events, rnd_gen=None, tie_breaker=None, profiler=None):
+        """Carries out a single round of the count.
+
+        The random selections of the round are taken from rnd_gen and
+        tie_breaker, as in randomly_select_first. The round is profiled
+        by the profiler, a CountProfiler, if given.
+        """
+
+        if profiler is None:
+            self._step(events, rnd_gen, tie_breaker, _untimed, None)
+            return
+        profiler.start_round(self.current_round, len(self.hopefuls) == 0)
+        self._step(events, rnd_gen, tie_breaker, profiler.timing,
+                   profiler.stats)
+        profiler.end_round()
+
+    def _step(self, events, rnd_gen, tie_breaker, timing, stats):
+        names = self.names
+        ids = self.ids
+        vote_count = self.vote_count
+        hopefuls = self.hopefuls
+        ranking = self.ranking
+        counter = self.counter
+        arithmetic = self.arithmetic
+        current_round = self.current_round
+        seats = self.seats
+        num_elected = self.num_elected
+        num_hopefuls = len(hopefuls)
+        fractional = self.fractional
+
+        if num_hopefuls == 0:
+            # If there is either a candidate with surplus votes, or
+            # there are hopeful candidates beneath the threshold.
+            if events.wants(Action.COUNT_ROUND):
+                events.emit(Event(Action.COUNT_ROUND, current_round, None,
+                                  None, None))
+            if events.wants(Action.ZOMBIES):
+                events.emit(Event(Action.ZOMBIES, current_round, None, None,
+                                  count_details(vote_count, self.eliminated,
+                                                names)))
+
+            best_candidate = self.eliminated.pop()
+            with timing('elect_reject'):
+                elect_reject(best_candidate, vote_count, self.constituencies,
+                             self.quota_limit, current_round,
+                             self.elected, self.rejected,
+                             self.constituencies_elected, names, events)
+            self.current_round += 1
+            return
+
+        # Report round
+        if events.wants(Action.COUNT_ROUND):
+            events.emit(Event(Action.COUNT_ROUND, current_round, None, None,
+                              None))
+        # Report count
+        if events.wants(Action.COUNT):
+            events.emit(Event(Action.COUNT, current_round, None, None,
+                              count_details(vote_count, hopefuls, names)))
+        # The hopefuls tied for the most votes
+        with timing('ranking'):
+            hopefuls_best = ranking.best()
         # If there is a surplus record it so that we can try to
         # redistribute the best candidate's votes according to their
         # next preferences
-        surplus = vote_count[hopefuls_sorted[0]] - threshold
+        surplus = vote_count[hopefuls_best[0]] - self.threshold
         # If there is either a candidate with surplus votes, or
         # there are hopeful candidates beneath the threshold.
         if fractional and (surplus > 0) or not fractional and (surplus >= 0) or num_hopefuls <= (seats - num_elected):
-            best_candidate = randomly_select_first(hopefuls_sorted,
-                                                   key=vote_count.get,
-                                                   action=Action.ELECT,
-                                                   random_generator=rnd_gen)
-            if best_candidate not in hopefuls:
+            with timing('selection'):
+                best_candidate = self._select(hopefuls_best, Action.ELECT,
+                                              events, rnd_gen, tie_breaker)
+            if (best_candidate not in ids
+                    or ids[best_candidate] not in hopefuls):
                 print("Not a valid candidate: ",best_candidate)
                 sys.exit(1)
+            best_candidate = ids[best_candidate]
             hopefuls.remove(best_candidate)
-            was_elected = elect_reject(best_candidate, vote_count,
-                                       constituencies, quota_limit,
-                                       current_round, 
-                                       elected, rejected,
-                                       constituencies_elected)
+            with timing('elect_reject'):
+                was_elected = elect_reject(best_candidate, vote_count,
+                                           self.constituencies,
+                                           self.quota_limit, current_round,
+                                           self.elected, self.rejected,
+                                           self.constituencies_elected,
+                                           names, events)
+            changed = ()
             if not was_elected:
-                redistribute_ballots(best_candidate, 1.0, hopefuls, allocated,
-                                     vote_count)
-            if surplus > 0:
+                with timing('redistribution'):
+                    changed = counter.redistribute(best_candidate,
+                                                   arithmetic.one, hopefuls,
+                                                   vote_count, events,
+                                                   current_round, stats)
+            # A rejected candidate has no surplus to transfer, as their
+            # ballots have already been transferred in full
+            elif surplus > 0:
                 # Calculate the weight for this round
-                weight = float(surplus) / vote_count[best_candidate]
+                weight = arithmetic.transfer_value(surplus,
+                                                   vote_count[best_candidate])
                 # Find the next eligible preference for each one of the ballots
                 # cast for the candidate, and transfer the vote to that
                 # candidate with its value adjusted by the correct weight.
-                redistribute_ballots(best_candidate, weight, hopefuls,
-                                     allocated, vote_count)
+                with timing('redistribution'):
+                    changed = counter.redistribute(best_candidate, weight,
+                                                   hopefuls, vote_count,
+                                                   events, current_round,
+                                                   stats)
+            with timing('ranking'):
+                ranking.update(changed)
         # If nobody can get elected, take the least hopeful candidate
         # (i.e., the hopeful candidate with the less votes) and
         # redistribute that candidate's votes.
         else:
-            hopefuls_sorted.reverse()
-            worst_candidate = randomly_select_first(hopefuls_sorted,
-                                                    key=vote_count.get,
-                                                    action=Action.ELIMINATE,
-                                                    random_generator=rnd_gen)
-            hopefuls.remove(worst_candidate)
-            eliminated.append(worst_candidate)
-            d = worst_candidate + " = " + str(vote_count[worst_candidate])
-            msg = LOG_MESSAGE.format(action=Action.ELIMINATE, desc=d)
-            logger.info(msg)
-            redistribute_ballots(worst_candidate, 1.0, hopefuls, allocated,
-                                 vote_count)
-            
-        current_round += 1
-        num_hopefuls = len(hopefuls)
-        num_elected = len(elected)
-
-    # If there is either a candidate with surplus votes, or
-    # there are hopeful candidates beneath the threshold.
-    while (seats - num_elected) > 0 and len(eliminated) > 0:
-        logger.info(LOG_MESSAGE.format(action=Action.COUNT_ROUND,
-                                       desc=current_round))
-        description  = count_description(vote_count, eliminated)
-        
-        logger.info(LOG_MESSAGE.format(action=Action.ZOMBIES,
-                                       desc=description))
+            hopeless = []
+            if self.bulk_exclusion:
+                with timing('ranking'):
+                    hopeless = self._hopeless()
+            if len(hopeless) > 1:
+                # Exclude the hopeless candidates together, with a single
+                # redistribution of all their ballots
+                for candidate in hopeless:
+                    hopefuls.remove(candidate)
+                    self.eliminated.append(candidate)
+                    if events.wants(Action.ELIMINATE):
+                        events.emit(Event(Action.ELIMINATE, current_round,
+                                          names[candidate],
+                                          vote_count[candidate], None))
+                with timing('redistribution'):
+                    changed = counter.redistribute_all(hopeless,
+                                                       arithmetic.one,
+                                                       hopefuls, vote_count,
+                                                       events, current_round,
+                                                       stats)
+            else:
+                with timing('ranking'):
+                    hopefuls_worst = ranking.worst()
+                with timing('selection'):
+                    worst_candidate = self._select(hopefuls_worst,
+                                                   Action.ELIMINATE, events,
+                                                   rnd_gen, tie_breaker)
+                worst_candidate = ids[worst_candidate]
+                hopefuls.remove(worst_candidate)
+                self.eliminated.append(worst_candidate)
+                if events.wants(Action.ELIMINATE):
+                    events.emit(Event(Action.ELIMINATE, current_round,
+                                      names[worst_candidate],
+                                      vote_count[worst_candidate], None))
+                with timing('redistribution'):
+                    changed = counter.redistribute(worst_candidate,
+                                                   arithmetic.one, hopefuls,
+                                                   vote_count, events,
+                                                   current_round, stats)
+            with timing('ranking'):
+                ranking.update(changed)
+
+        self.current_round += 1
+        self.num_elected = len(self.elected)
+
+    def run(self, events, rnd_gen=None, tie_breaker=None, profiler=None):
+        """Carries out the rounds left, and returns the results.
+
+        The threshold is reported if the count has not started. The
+        results are as those of count_stv.
+        """
+
+        if self.current_round == 1 and events.wants(Action.THRESHOLD):
+            events.emit(Event(Action.THRESHOLD, None, None, self.threshold,
+                              None))
+        while not self.finished():
+            self.step(events, rnd_gen, tie_breaker, profiler)
+        return self.results()
+
+    def results(self):
+        """Returns the elected candidates and the vote count.
+
+        Votes are given as numbers of votes, see count_stv.
+        """
+
+        display = self.arithmetic.display
+        return ([(x[0], x[1], display(x[2])) for x in self.elected],
+                dict(zip(self.names, map(display, self.vote_count))))
+
+    def fork(self):
+        """Returns a copy of the state that is carried forward on its own.
+
+        The ballots of the store are shared, as a count does not change
+        them; everything else is copied.
+        """
 
-        best_candidate = eliminated.pop()
-        elect_reject(best_candidate, vote_count, constituencies,
-                     quota_limit, current_round,
-                     elected, rejected, constituencies_elected)
-        current_round += 1
+        store = self.store
+        memo = {id(store): store}
+        for value in vars(store).values():
+            memo[id(value)] = value
+        return copy.deepcopy(self, memo)
 
-    return elected, vote_count
+    def fingerprint(self):
+        """Returns a digest of the state that decides the rest of the count.
+
+        Two states with the same fingerprint elect the same candidates
+        for the same random selections, whatever the rounds that led to
+        them. The digest covers the tallies and the allocation of the
+        ballots, and the elected, hopeful, eliminated and rejected
+        candidates; the order of election, round numbers and manual
+        selections are left out, and so is the order of elimination when
+        there is no constituency quota.
+        """
+
+        eliminated = self.eliminated
+        if not self.quota_limit:
+            # Without quotas every zombie is elected, in whatever order
+            eliminated = sorted(eliminated)
+        digest = hashlib.sha256()
+        digest.update(pickle.dumps((
+            self.vote_count, bytes(self.hopefuls.flags),
+            sorted(x[0] for x in self.elected), self.num_elected,
+            eliminated, sorted(x[0] for x in self.rejected),
+            sorted(self.constituencies_elected.items()))))
+        self.counter.fingerprint(digest)
+        return digest.digest()
+
+    def save(self, path):
+        """Saves the state to a checkpoint file at path."""
+
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp',
+                                         delete=False) as checkpoint_file:
+            pickle.dump(self, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(checkpoint_file.name, path)
+
+    @staticmethod
+    def load(path):
+        """Returns the state saved to the checkpoint file at path.
+
+        Checkpoints are pickles, so only load checkpoints you trust.
+        """
+
+        with open(path, 'rb') as checkpoint_file:
+            return pickle.load(checkpoint_file)
+
+def count_stv(ballots, seats, droop = True, constituencies = None,
+              quota_limit = 0, rnd_gen=None, fractional = False,
+              engine = 'python', subscriber=None, decimals=None,
+              weight_history=None, tie_breaker=None, rng=None,
+              profiler=None, bulk_exclusion=False):
+    """Performs a STV vote for the given ballots and number of seats.
+
+    The ballots are either a BallotStore or an iterable of Ballot
+    objects, which are interned and grouped into a BallotStore before
+    counting, so that the count works on each distinct ballot once;
+    num_ballots below is the total count of the ballots.
+    If droop is true the election threshold is calculated according to the
+    Droop quota:
+            threshold = int(1 + (num_ballots / (seats + 1)))
+    If it is a fractional droop, then it is calculated with:
+            threshold = (num_ballots / (seats + 1))
+    otherwise it is calculated according to the following formula:
+            threshold = int(math.ceil(1 + num_ballots / (seats + 1)))
+    The constituencies argument is a map of candidates to constituencies, if
+    any. The quota_limit, if different than zero, is the limit of candidates
+    that can be elected by a constituency. The engine is the name of the
+    counting engine in ENGINES; all engines give the same results, up
+    to floating point rounding. The events of the count are logged, and
+    given to the subscriber, if any, a callable that takes an Event.
+    If decimals is given, ballot values and tallies are fixed point
+    numbers with that many decimal places, and votes are reported as
+    Decimal numbers; otherwise they are floating point numbers.
+    The weights applied to the ballots are only kept if a WeightHistory
+    is given as weight_history, which then records every transfer; its
+    ballot indices refer to the ballots of the BallotStore.
+    Tied candidates are selected with rnd_gen, a list of candidate
+    names to select, and then with tie_breaker, if given, a callable
+    that takes the names of the tied candidates and the action and
+    returns the name to select; see randomly_select_first. Random
+    selections are drawn from rng, a random.Random instance, if given.
+    The rounds are profiled by the profiler, a CountProfiler, if given;
+    its callback is called with the profile of each round as it ends.
+    If bulk_exclusion is true, a round that elects nobody excludes at
+    once all the hopefuls with the fewest votes whose votes together
+    are fewer than those of the next hopeful, as long as that leaves
+    as many hopefuls as seats to fill, instead of the single hopeful
+    with the fewest votes; their ballots are redistributed together.
+    """
+
+    state = CountState(ballots, seats, droop, constituencies, quota_limit,
+                       fractional, engine, decimals, weight_history, rng,
+                       bulk_exclusion)
+    return state.run(state.event_stream(subscriber), rnd_gen, tie_breaker,
+                     profiler)
+
+class RoundRecorder:
+    """Records the tallies and the decisions of each round of a count.
+
+    The recorder is a subscriber to the events of a count. Each round
+    is recorded as a dictionary with the round number, whether it is a
+    round with zombies, the votes of the hopeful candidates, or of the
+    zombies, at its start, the decision as an (action, candidate,
+    votes) tuple, and whether a random selection was made. Votes are
+    numbers of votes, as the events carry them.
+
+    """
+
+    ACTIONS = (Action.THRESHOLD, Action.COUNT_ROUND, Action.COUNT,
+               Action.ZOMBIES, Action.ELECT, Action.QUOTA,
+               Action.ELIMINATE, Action.RANDOM)
+
+    def __init__(self):
+        self.threshold = None
+        self.rounds = []
+
+    def accepts(self, action):
+        return action in self.ACTIONS
+
+    def __call__(self, event):
+        action = event.action
+        if action == Action.THRESHOLD:
+            self.threshold = event.value
+        elif action == Action.COUNT_ROUND:
+            self.rounds.append({'round': event.round, 'zombies': False,
+                                'votes': {}, 'decision': None,
+                                'random': False})
+        elif action in (Action.COUNT, Action.ZOMBIES):
+            self.rounds[-1]['votes'] = dict(event.details)
+            self.rounds[-1]['zombies'] = action == Action.ZOMBIES
+        elif action == Action.RANDOM:
+            self.rounds[-1]['random'] = True
+        else:
+            self.rounds[-1]['decision'] = (action, event.candidate,
+                                           event.value)
+
+class IncrementalCount:
+    """A STV count that is updated as late ballots arrive.
+
+    The ballots are kept in a BallotStore, so that late ballots are
+    merged into it instead of reading all the ballots again, and the
+    tallies and decisions of each round of the last count are recorded.
+    The arguments are those of CountState.
+
+    If the last count transferred only whole ballots, which is the case
+    unless a candidate was elected with a surplus, late ballots do not
+    change the values of the other ballots, so that as long as the
+    count takes the same decisions, each tally is the recorded tally
+    plus the votes of the late ballots. The late ballots alone are then
+    taken through the recorded decisions, and if each decision still
+    follows from the updated tallies, without ties and without a
+    surplus to transfer, the count would take the same decisions, and
+    the results are updated without counting the other ballots again.
+    Otherwise all the ballots are counted again.
+
+    """
+
+    def __init__(self, ballots, seats, droop=True, constituencies=None,
+                 quota_limit=0, fractional=False, engine='python',
+                 decimals=None):
+        if isinstance(ballots, BallotStore):
+            if isinstance(ballots.counts, memoryview):
+                ballots = ballots.copy()
+        else:
+            ballots = load_ballots(ballots, constituencies or {})
+        self.store = ballots
+        self.seats = seats
+        self.droop = droop
+        self.constituencies = constituencies
+        self.quota_limit = quota_limit
+        self.fractional = fractional
+        self.engine = engine
+        self.decimals = decimals
+        self.rounds = None
+        self.results = None
+        # Whether the last update counted all the ballots again
+        self.recounted = None
+
+    def _arithmetic(self):
+        if self.decimals is None:
+            return FloatArithmetic()
+        return FixedPointArithmetic(self.decimals)
+
+    def count(self, rnd_gen=None, tie_breaker=None, subscriber=None):
+        """Counts all the ballots, and returns the results of count_stv."""
+
+        recorder = RoundRecorder()
+        state = CountState(self.store, self.seats, self.droop,
+                           self.constituencies, self.quota_limit,
+                           self.fractional, self.engine, self.decimals)
+        events = state.event_stream(subscriber)
+        events.subscribers.append(recorder)
+        self.results = state.run(events, rnd_gen, tie_breaker)
+        self.threshold = recorder.threshold
+        self.rounds = recorder.rounds
+        self.recounted = True
+        return self.results
+
+    def add(self, ballots, rnd_gen=None, tie_breaker=None, subscriber=None):
+        """Adds late ballots, an iterable of Ballot objects, to the count.
+
+        Returns the updated results. The random selections and the
+        subscriber are only used if all the ballots are counted again;
+        recounted tells whether they were.
+        """
+
+        store = self.store
+        late = BallotStore()
+        for name in store.names:
+            late.intern(name)
+        late.extend(ballots)
+        new_candidates = len(late.names) > len(store.names)
+        for index in range(len(late)):
+            store.add(late.candidates(index), late.counts[index])
+        if (self.rounds is None or new_candidates
+                or not self._update(late)):
+            # The rounds do not count the merged ballots, so a recount
+            # that fails must leave the next update to count them all
+            self.rounds = None
+            self.results = None
+            return self.count(rnd_gen, tie_breaker, subscriber)
+        self.recounted = False
+        return self.results
+
+    def _update(self, late):
+        """Updates the results with the late ballots, if they are unchanged.
+
+        Returns false, changing nothing, if the decisions of the count
+        may change.
+        """
+
+        arithmetic = self._arithmetic()
+        if arithmetic.scale is not None and late.counts.typecode != 'Q':
+            # Truncating fractional counts does not add up
+            return False
+        whole_counts = memoryview(self.store.counts).format == 'Q'
+        display = arithmetic.display
+        threshold = self.threshold
+        last = len(self.rounds) - 1
+        for index, record in enumerate(self.rounds):
+            action, name, votes = record['decision']
+            if record['random']:
+                return False
+            if (action in (Action.ELECT, Action.QUOTA)
+                    and not record['zombies'] and votes > threshold):
+                # A surplus changes the values of the ballots transferred,
+                # unless it is the last transfer of the count; there the
+                # transferred ballots can be told from the tallies if
+                # they are whole ballots with floating point values.
+                if (index < last or action == Action.QUOTA
+                        or arithmetic.scale is not None
+                        or not whole_counts):
+                    return False
+
+        threshold = display(arithmetic.amount(election_threshold(
+            self.store.total(), self.seats, self.droop, self.fractional)))
+        names = late.names
+        ids = late.ids
+        counter = ENGINES[self.engine](late, arithmetic)
+        vote_count = counter.initial_count()
+        hopefuls = Hopefuls(len(names))
+        one = arithmetic.one
+        num_elected = 0
+        rounds = []
+        elected = []
+        # The ballots of the last round's surplus, per recipient, and
+        # the new transfer value
+        transferred = None
+        weight = 0
+        for index, record in enumerate(self.rounds):
+            action, name, old_votes = record['decision']
+            votes = {x: v + display(vote_count[ids[x]])
+                     for x, v in record['votes'].items()}
+            if not record['zombies']:
+                if len(votes) != len(hopefuls):
+                    return False
+                ranked = sorted(votes.values())
+                best = max(votes, key=votes.get)
+                worst = min(votes, key=votes.get)
+                surplus = votes[best] - threshold
+                to_elect = (self.fractional and (surplus > 0)
+                            or not self.fractional and (surplus >= 0)
+                            or len(votes) <= (self.seats - num_elected))
+                if action == Action.ELIMINATE:
+                    if (to_elect or name != worst
+                            or len(ranked) > 1 and ranked[0] == ranked[1]):
+                        return False
+                elif (not to_elect or name != best
+                        or len(ranked) > 1 and ranked[-1] == ranked[-2]):
+                    return False
+                old_surplus = old_votes - self.threshold
+                if action == Action.ELECT and old_surplus > 0:
+                    transferred = {}
+                    old_weight = arithmetic.transfer_value(old_surplus,
+                                                           old_votes)
+                    for x, v in record['votes'].items():
+                        if x != name:
+                            moved = (self.results[1][x] - v) / old_weight
+                            transferred[x] = round(moved)
+                            if abs(moved - transferred[x]) > 1e-6:
+                                return False
+                elif surplus > 0:
+                    return False
+                hopefuls.remove(ids[name])
+                if action != Action.ELECT:
+                    counter.redistribute(ids[name], one, hopefuls,
+                                         vote_count)
+                elif surplus > 0:
+                    weight = arithmetic.transfer_value(surplus, votes[name])
+                    counter.redistribute(ids[name], weight, hopefuls,
+                                         vote_count)
+            if action == Action.ELECT:
+                elected.append((name, record['round'], votes[name]))
+                if not record['zombies']:
+                    num_elected += 1
+            rounds.append(dict(record, votes=votes,
+                               decision=(action, name, votes[name])))
+
+        final = self.results[1]
+        if transferred is not None:
+            # Take back the last transfer, and carry it out anew
+            final = dict(final)
+            record = self.rounds[-1]
+            _, name, old_votes = record['decision']
+            for x, moved in transferred.items():
+                final[x] = record['votes'][x] + moved * weight
+            final[name] = old_votes - sum(transferred.values()) * weight
+        self.threshold = threshold
+        self.rounds = rounds
+        self.results = (elected,
+                        {x: final[x] + display(vote_count[ids[x]])
+                         for x in final})
+        return True
+
+def election_probabilities(names, winner_sets):
+    """Returns the probability that each candidate is elected.
+
+    The winner_sets map sorted tuples of the names of the elected
+    candidates to their probabilities.
+    """
+
+    probabilities = dict.fromkeys(names, 0)
+    for winner_set, probability in winner_sets.items():
+        for name in winner_set:
+            probabilities[name] += probability
+    return probabilities
+
+def explore_ties(state):
+    """Returns the probability of each outcome of the count of the state.
+
+    Every random selection among n tied candidates is followed, each
+    with probability 1/n, so that all the outcomes reachable through
+    random selections are found. A selection forks the state at the
+    start of the tied round, rather than counting again from the first
+    round, and the outcome of each distinct state is only worked out
+    once, as states reached along different paths are merged by their
+    fingerprints.
+
+    Returns the probability that each candidate is elected, the
+    probability of each set of elected candidates, given as a sorted
+    tuple of names, as exact fractions, and the number of distinct
+    states explored.
+    """
+
+    events = EventStream()
+    outcomes = {}
+
+    def explore(state):
+        key = state.fingerprint()
+        if key in outcomes:
+            return outcomes[key]
+        try:
+            elected, _ = state.run(events, [])
+            result = {tuple(sorted(x[0] for x in elected)): Fraction(1)}
+        except MissingRandomValue as tie:
+            result = {}
+            share = Fraction(1, len(tie.candidates))
+            for candidate in tie.candidates:
+                branch = state.fork()
+                branch.step(events, [candidate])
+                for winner_set, probability in explore(branch).items():
+                    result[winner_set] = (result.get(winner_set, 0)
+                                          + share * probability)
+        outcomes[key] = result
+        return result
+
+    winner_sets = explore(state)
+    winner_sets = dict(sorted(winner_sets.items(), key=lambda x: -x[1]))
+    return (election_probabilities(state.names, winner_sets), winner_sets,
+            len(outcomes))
+
+# The ballots and the count options of a Monte Carlo worker process
+_monte_carlo_worker = {}
+
+def _monte_carlo_init(memory_name, seats, options):
+    """Sets up a worker with the binary ballots in shared memory."""
+
+    memory = shared_memory.SharedMemory(memory_name)
+    _monte_carlo_worker['memory'] = memory
+    _monte_carlo_worker['store'] = binary_store(memory.buf)
+    _monte_carlo_worker['seats'] = seats
+    _monte_carlo_worker['options'] = options
+
+def _monte_carlo_counts(run_seeds):
+    """Counts the ballots of the worker once for each one of the seeds.
+
+    Returns the names of the elected candidates of each count, sorted.
+    """
+
+    store = _monte_carlo_worker['store']
+    seats = _monte_carlo_worker['seats']
+    options = _monte_carlo_worker['options']
+    winners = []
+    for run_seed in run_seeds:
+        state = CountState(store, seats, rng=Random(run_seed), **options)
+        elected, _ = state.run(EventStream())
+        winners.append(tuple(sorted(x[0] for x in elected)))
+    return winners
+
+def monte_carlo(store, seats, runs, processes=None, base_seed=None,
+                **options):
+    """Counts the ballots of the store runs times, with random tie breaks.
+
+    Each count draws its random selections from a random.Random of its
+    own, seeded with base_seed plus the number of the count, so that the
+    analysis can be repeated; base_seed is random if not given. The
+    counts are shared among processes worker processes, by default as
+    many as there are CPUs, which map the ballots in binary form from
+    shared memory. The options are the keyword arguments of CountState.
+
+    Returns the fraction of the counts in which each candidate was
+    elected, and the fraction of the counts that elected each set of
+    candidates, given as a sorted tuple of names.
+    """
+
+    if base_seed is None:
+        base_seed = Random().getrandbits(64)
+    run_seeds = range(base_seed, base_seed + runs)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    buffer = io.BytesIO()
+    write_binary_ballots(store, buffer)
+    data = buffer.getbuffer()
+    memory = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    try:
+        memory.buf[:len(data)] = data
+        del data
+        chunk = max(1, runs // (4 * processes))
+        chunks = [run_seeds[i:i + chunk] for i in range(0, runs, chunk)]
+        winners = Counter()
+        if processes == 1:
+            _monte_carlo_worker.update(store=store, seats=seats,
+                                       options=options)
+            try:
+                for chunk_seeds in chunks:
+                    winners.update(_monte_carlo_counts(chunk_seeds))
+            finally:
+                _monte_carlo_worker.clear()
+        else:
+            with multiprocessing.Pool(processes, _monte_carlo_init,
+                                      (memory.name, seats,
+                                       options)) as pool:
+                for chunk_winners in pool.imap_unordered(
+                        _monte_carlo_counts, chunks):
+                    winners.update(chunk_winners)
+    finally:
+        memory.close()
+        memory.unlink()
+
+    winner_sets = {winner_set: times / runs
+                   for winner_set, times in winners.most_common()}
+    return election_probabilities(store.names, winner_sets), winner_sets
+
+def print_probabilities(probabilities, winner_sets):
+    """Prints election probabilities and winner set probabilities."""
+
+    print("Election probabilities:")
+    for name, probability in sorted(probabilities.items(),
+                                    key=lambda x: -x[1]):
+        print("{0} {1:.4f}".format(name, float(probability)))
+    print("Winner sets:")
+    for winner_set, probability in winner_sets.items():
+        print("{0:.4f} {1}".format(float(probability), winner_set))
+
+def convert(argv):
+    """Converts a CSV or JSON ballots file to a binary ballots file."""
+
+    parser = argparse.ArgumentParser(
+        prog='stv.py convert',
+        description='Convert a ballots file to a binary ballots file')
+    parser.add_argument('-b', '--ballots', default='sys.stdin',
+                        dest='ballots_file', help='input ballots file')
+    parser.add_argument('-j', '--json', action="store_true",
+                        dest='json', help='Read ballots file as JSON')
+    parser.add_argument('-c', '--constituencies',
+                        dest='constituencies_file',
+                        help='input constituencies file, whose '
+                        'candidates come first')
+    parser.add_argument('-o', '--output', required=True,
+                        dest='output_file', help='output binary file')
+    args = parser.parse_args(argv)
+
+    constituencies = {}
+    if args.constituencies_file:
+        constituencies = read_constituencies(args.constituencies_file)
+    store = read_ballots(args.ballots_file, args.json, constituencies)
+    with open(args.output_file, 'wb') as binary_file:
+        write_binary_ballots(store, binary_file)
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['convert']:
+        convert(sys.argv[2:])
+        sys.exit(0)
+
     parser = argparse.ArgumentParser(description='Perform STV')
     parser.add_argument('-b', '--ballots', default='sys.stdin',
                         dest='ballots_file', help='input ballots file')
@@ -366,65 +2395,119 @@ if __name__ == "__main__":
                         dest='loglevel', help='logging level')
     parser.add_argument('-j', '--json', action="store_true",
                         dest='json', help='Read ballots file as JSON')
+    parser.add_argument('-e', '--engine', default='python',
+                        choices=sorted(ENGINES),
+                        dest='engine', help='counting engine')
+    parser.add_argument('-d', '--decimals', type=int, default=None,
+                        dest='decimals',
+                        help='count with fixed point numbers of DECIMALS '
+                        'decimal places')
+    parser.add_argument('--cache', dest='cache_dir',
+                        help='directory in which to cache parsed ballots')
+    parser.add_argument('--checkpoint', dest='checkpoint_file',
+                        help='file to save the count to when a random '
+                        'selection is missing')
+    parser.add_argument('--resume', dest='resume_file',
+                        help='checkpoint file to resume the count from')
+    parser.add_argument('-i', '--interactive', nargs='?', const='-',
+                        dest='interactive', metavar='FIFO',
+                        help='ask for missing random selections, on the '
+                        'terminal or from FIFO')
+    parser.add_argument('--monte-carlo', type=int, dest='runs',
+                        help='count RUNS times with random selections and '
+                        'report how often each candidate is elected')
+    parser.add_argument('--explore', action='store_true', dest='explore',
+                        help='find the probability of every outcome of the '
+                        'random selections')
+    parser.add_argument('--processes', type=int, dest='processes',
+                        help='number of processes for --monte-carlo')
+    parser.add_argument('--seed', type=int, dest='seed',
+                        help='first random seed for --monte-carlo')
+    parser.add_argument('--bulk-exclusion', action='store_true',
+                        dest='bulk_exclusion',
+                        help='exclude together all the candidates that '
+                        'cannot overtake the next candidate')
+    parser.add_argument('--profile', dest='profile_file',
+                        help='JSON file to write a profile of each round '
+                        'of the count to')
     args = parser.parse_args()
 
     if args.fractional and not args.droop:
         parser.error("Cannot use fractional droop method if not using the droop method!")
 
+    if args.decimals is not None and not 0 <= args.decimals <= 9:
+        parser.error("The number of decimals must be between 0 and 9")
+
     stream_handler = logging.StreamHandler(stream=sys.stdout)
     logger = logging.getLogger(SVT_LOGGER)
     logger.setLevel(args.loglevel)
     logger.addHandler(stream_handler)
 
-    ballots = []
-    ballots_file = sys.stdin
-    should_close_ballots_file = False
-
-    if args.ballots_file != 'sys.stdin':
-         ballots_file = open(args.ballots_file, 'r')
-         should_close_ballots_file = True
-    
-    if not args.json:
-        ballots_reader = csv.reader(ballots_file, delimiter=',',
-                                    quotechar='"',
-                                    skipinitialspace=True)
-        for ballot in ballots_reader:
-            ballots.append(Ballot(ballot))
+    random_values = args.random
+    if args.resume_file:
+        # The count options and the ballots come from the checkpoint
+        state = CountState.load(args.resume_file)
+        if random_values is not None:
+            made = state.manual_selections
+            if random_values[:len(made)] != made:
+                parser.error("The random selection results must start "
+                             "with those of the checkpoint: "
+                             "{0}".format(made))
+            random_values = random_values[len(made):]
     else:
-        # ======== ARTUR @ SNET ===========================
-        votes_list = json.load(ballots_file)
-    
-        DEBUG_FACTOR = 1
-        for v in votes_list:
-            votes_token = range(0, int(float(v["balance"])/DEBUG_FACTOR))
-            for b in votes_token:
-                ballots.append(Ballot(v["candidates"]))
-        # =================================================
+        constituencies = {}
+        if args.constituencies_file:
+            constituencies = read_constituencies(args.constituencies_file)
 
-    if should_close_ballots_file:
-        ballots_file.close()
+        ballots = read_ballots(args.ballots_file, args.json, constituencies,
+                               args.cache_dir)
 
-    if args.seats == 0:
-        args.seats = len(ballots) / 2
+        if args.seats == 0:
+            args.seats = ballots.total() / 2
 
-    constituencies = {}
-    if args.constituencies_file:
-        constituencies_file = open(args.constituencies_file, 'U')
-        constituencies_reader = csv.reader(constituencies_file,
-                                           delimiter=',',
-                                           quotechar='"',
-                                           skipinitialspace=True)
-        constituency_id = 0
-        for constituency in constituencies_reader:
-            for candidate in constituency:
-                constituencies[candidate] = constituency_id
-            constituency_id += 1
-        
-    (elected, vote_count) = count_stv(ballots, args.seats, args.droop,
-                                      constituencies,
-                                      args.quota,
-                                      args.random,
-                                      args.fractional)
+        if args.runs:
+            (probabilities, winner_sets) = monte_carlo(
+                ballots, args.seats, args.runs, args.processes, args.seed,
+                droop=args.droop, constituencies=constituencies,
+                quota_limit=args.quota, fractional=args.fractional,
+                engine=args.engine, decimals=args.decimals,
+                bulk_exclusion=args.bulk_exclusion)
+            print_probabilities(probabilities, winner_sets)
+            sys.exit(0)
+
+        state = CountState(ballots, args.seats, args.droop, constituencies,
+                           args.quota, args.fractional, args.engine,
+                           args.decimals, bulk_exclusion=args.bulk_exclusion)
+
+    if args.explore:
+        (probabilities, winner_sets, num_states) = explore_ties(state)
+        print_probabilities(probabilities, winner_sets)
+        print("States explored: {0}".format(num_states))
+        sys.exit(0)
+
+    tie_breaker = None
+    if args.interactive == '-':
+        tie_breaker = PromptTieBreaker()
+    elif args.interactive:
+        tie_breaker = PromptTieBreaker(args.interactive)
+
+    profiler = None
+    if args.profile_file:
+        profiler = CountProfiler()
+
+    try:
+        (elected, vote_count) = state.run(state.event_stream(),
+                                          random_values, tie_breaker,
+                                          profiler)
+    except MissingRandomValue as e:
+        print("Missing value for random selection among ", e.candidates)
+        if args.checkpoint_file:
+            state.save(args.checkpoint_file)
+        sys.exit(1)
+    finally:
+        if profiler is not None:
+            with open(args.profile_file, 'w') as profile_file:
+                json.dump(profiler.trace(), profile_file, indent=2)
 
     print("Results:")
     for result in elected: